@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import datetime
+import math
+
+
+# The times of day (see --time) as a schedule for the day, worked out once:
+# which time of day it is is a lookup by the minute, and when it next
+# changes a bisect over the times it changes at.
+
+MINUTES_PER_DAY = 24 * 60
+
+LABELS = {
+    2: ['day', 'night'],
+    3: ['day', 'evening', 'night'],
+    4: ['morning', 'day', 'evening', 'night'],
+    'solar': ['morning', 'day', 'evening', 'night'],
+}
+
+# When each time of day starts, for each --time level. Each lasts until the
+# next one starts, and the last one until the first one the next day.
+DEFAULT_THRESHOLDS = {
+    2: ['06:00', '20:00'],
+    3: ['06:00', '17:00', '20:00'],
+    4: ['06:00', '08:00', '17:00', '20:00'],
+}
+
+# Altitudes of the sun's centre (degrees) at sunrise and sunset (allowing for
+# refraction and the size of the sun), and where civil twilight ends
+SUNRISE_ALTITUDE = -0.833
+CIVIL_TWILIGHT_ALTITUDE = -6
+
+# Schedules, keyed by (level, thresholds)
+schedules = {}
+
+# Schedules for --time solar, for one day each, keyed by (date, latitude, longitude)
+solar_schedules = {}
+
+# Days to keep in solar_schedules
+SOLAR_SCHEDULE_DAYS = 3
+
+
+def parse_time(text):
+    # Minutes since midnight of "HH:MM"
+
+    try:
+        hours, minutes = [int(i) for i in text.split(':')]
+    except ValueError:
+        raise ValueError('{} is not a time, expected HH:MM'.format(text))
+
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError('{} is not a time, expected HH:MM'.format(text))
+
+    return hours * 60 + minutes
+
+
+class Schedule:
+
+    def __init__(self, labels, starts):
+        # starts: minutes since midnight at which each of labels starts
+
+        if len(starts) != len(labels):
+            raise ValueError('Expected {} times, one for each of {}'.format(len(labels), ', '.join(labels)))
+
+        if any(earlier >= later for earlier, later in zip(starts, starts[1:])):
+            raise ValueError('The times have to be in order, from the first to the last time of day')
+
+        self.labels = labels
+        self.starts = starts
+
+        # The time of day at each minute of the day. Before the first start
+        # it is still the last one (index -1) from the day before.
+        self.table = [labels[bisect.bisect_right(starts, minute) - 1] for minute in range(MINUTES_PER_DAY)]
+
+    def get_period(self, now=None):
+        # The time of day at now
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        return self.table[now.hour * 60 + now.minute]
+
+    def get_next_boundary(self, now=None):
+        # When the time of day next changes after now
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        index = bisect.bisect_right(self.starts, now.hour * 60 + now.minute)
+
+        if index == len(self.starts):
+            return midnight + datetime.timedelta(days=1, minutes=self.starts[0])
+
+        return midnight + datetime.timedelta(minutes=self.starts[index])
+
+
+def get_schedule(level=3, thresholds=None):
+    # thresholds: when each time of day starts, as "HH:MM", the default ones
+    # for level if None
+
+    key = (level, tuple(thresholds or DEFAULT_THRESHOLDS[level]))
+
+    if key not in schedules:
+        schedules[key] = Schedule(LABELS[level], [parse_time(i) for i in key[1]])
+
+    return schedules[key]
+
+
+def get_sun_times(date, latitude, longitude, altitude):
+    # When the sun's centre rises above and sets below altitude (degrees) on
+    # date, as UTC datetimes, worked out with the sunrise equation. (None,
+    # None) if it stays below all day, and (False, False) if it stays above.
+
+    # Days since J2000 (noon, 1 January 2000 UTC), at the mean solar noon
+    # of longitude (east positive)
+    days = (date - datetime.date(2000, 1, 1)).days + 0.0008 - longitude / 360
+
+    anomaly = math.radians((357.5291 + 0.98560028 * days) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+
+    transit = days + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(23.4397)))
+
+    cos_hour_angle = ((math.sin(math.radians(altitude)) - math.sin(math.radians(latitude)) * math.sin(declination)) /
+                      (math.cos(math.radians(latitude)) * math.cos(declination)))
+
+    if cos_hour_angle > 1:
+        return None, None
+
+    if cos_hour_angle < -1:
+        return False, False
+
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+
+    j2000 = datetime.datetime(2000, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+    return (j2000 + datetime.timedelta(days=transit - hour_angle / 360),
+            j2000 + datetime.timedelta(days=transit + hour_angle / 360))
+
+
+def get_solar_changes(date, latitude, longitude):
+    # [(local datetime, time of day it changes to)] for the days around date:
+    # morning at dawn, day at sunrise, evening at sunset and night at dusk
+
+    changes = []
+
+    for day in [date - datetime.timedelta(days=1), date, date + datetime.timedelta(days=1)]:
+        sunrise, sunset = get_sun_times(day, latitude, longitude, SUNRISE_ALTITUDE)
+        dawn, dusk = get_sun_times(day, latitude, longitude, CIVIL_TWILIGHT_ALTITUDE)
+
+        # No sunrise or no dusk at high latitudes leaves those out, and the
+        # time of day stays what it was
+        for when, label in [(dawn, 'morning'), (sunrise, 'day'), (sunset, 'evening'), (dusk, 'night')]:
+            if when:
+                changes.append((when.astimezone().replace(tzinfo=None), label))
+
+        if sunrise is False:
+            # Midnight sun
+            changes.append((datetime.datetime.combine(day, datetime.time()), 'day'))
+
+        elif dawn is None:
+            # Polar night
+            changes.append((datetime.datetime.combine(day, datetime.time()), 'night'))
+
+    return sorted(changes)
+
+
+def make_solar_schedule(date, latitude, longitude):
+    # A Schedule for just date, from the sun's position
+
+    midnight = datetime.datetime.combine(date, datetime.time())
+
+    changes = get_solar_changes(date, latitude, longitude)
+
+    # The time of day at midnight is what the last change before it made it.
+    # With no change at all, the sun stays between civil twilight and the
+    # horizon for days: twilight, taken as morning.
+    earlier = [label for when, label in changes if when < midnight]
+    labels = [earlier[-1] if earlier else 'morning']
+    starts = [0]
+
+    for when, label in changes:
+        if midnight <= when < midnight + datetime.timedelta(days=1):
+            minute = when.hour * 60 + when.minute
+
+            if minute == starts[-1]:
+                labels[-1] = label
+            else:
+                starts.append(minute)
+                labels.append(label)
+
+    return Schedule(labels, starts)
+
+
+class SolarSchedule:
+    # Like Schedule, but with the times of day following the sun at
+    # latitude, longitude, worked out locally once for each day
+
+    labels = LABELS['solar']
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def get_day_schedule(self, date):
+        key = (date, self.latitude, self.longitude)
+
+        if key not in solar_schedules:
+            if len(solar_schedules) >= SOLAR_SCHEDULE_DAYS:
+                del solar_schedules[min(solar_schedules)]
+
+            solar_schedules[key] = make_solar_schedule(date, self.latitude, self.longitude)
+
+        return solar_schedules[key]
+
+    def get_period(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+
+        return self.get_day_schedule(now.date()).get_period(now)
+
+    def get_next_boundary(self, now=None):
+        # Looking at most to the end of the next day, when a different
+        # schedule takes over anyway
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        for day in range(2):
+            date = now.date() + datetime.timedelta(days=day)
+            schedule = self.get_day_schedule(date)
+            midnight = datetime.datetime.combine(date, datetime.time())
+
+            for start, label in zip(schedule.starts, schedule.labels):
+                when = midnight + datetime.timedelta(minutes=start)
+
+                if when > now and label != self.get_period(when - datetime.timedelta(minutes=1)):
+                    return when
+
+        return datetime.datetime.combine(now.date() + datetime.timedelta(days=2), datetime.time())
+
+
+def parse_location(text):
+    # (latitude, longitude) of "latitude,longitude", as ipinfo.io and
+    # --location give it
+
+    try:
+        latitude, longitude = [float(i) for i in text.split(',')]
+    except (AttributeError, ValueError):
+        raise ValueError('{} is not a location, expected latitude,longitude'.format(text))
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('{} is not a location, expected latitude,longitude'.format(text))
+
+    return latitude, longitude
@@ -28,13 +28,57 @@
 import os
 import sys
 import subprocess
-import configparser
-from textwrap import dedent
+import time
 
 
 # Library to set wallpaper and find desktop - Cross-platform
 
+# Seconds a desktop's command may take before we give up on it
+COMMAND_TIMEOUT = 30
+
+GNOME_DESKTOPS = ['gnome', 'unity', 'cinnamon', 'pantheon']
+
+# Desktops that take a GNOME background XML slideshow for the wallpaper, and
+# change it by themselves
+SLIDESHOW_DESKTOPS = GNOME_DESKTOPS + ['mate', 'gnome2']
+
+KDE_SCRIPT = '''\
+var Desktops = desktops();
+for (i=0;i<Desktops.length;i++) {
+    d = Desktops[i];
+    d.wallpaperPlugin = "org.kde.image";
+    d.currentConfigGroup = Array("Wallpaper",
+                                "org.kde.image",
+                                "General");
+    d.writeConfig("Image", "file://%s")
+}
+'''
+
+# The Backend for each desktop, made once per session
+backends = {}
+
+# How long setting the wallpaper took, keyed by desktop:
+# {'calls': ..., 'total': ..., 'last': ..., 'max': ...} (in seconds)
+backend_timings = {}
+
+# Detected desktops, keyed by the session variables they were detected from
+desktop_environment_cache = {}
+
+
 def get_desktop_environment():
+    # The desktop does not change during a session, so only detect it again
+    # if the session variables do
+
+    session = (os.environ.get('XDG_CURRENT_DESKTOP'), os.environ.get('DESKTOP_SESSION'))
+
+    if session not in desktop_environment_cache:
+        desktop_environment_cache.clear()
+        desktop_environment_cache[session] = detect_desktop_environment()
+
+    return desktop_environment_cache[session]
+
+
+def detect_desktop_environment():
     if sys.platform in ['win32', 'cygwin']:
         return 'windows'
 
@@ -99,7 +143,25 @@ def get_desktop_environment():
 
 
 def is_running(process):
-    try:  # Linux/Unix
+    if os.path.isdir('/proc'):  # Linux
+        # Read the command lines directly instead of forking ps
+        process = process.encode('utf-8')
+
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+
+            try:
+                with open(os.path.join(entry.path, 'cmdline'), 'rb') as f:
+                    if process in f.read():
+                        return True
+
+            except OSError:  # Exited in the meantime
+                continue
+
+        return False
+
+    try:  # Other Unix
         s = subprocess.Popen(['ps', 'axw'], stdout=subprocess.PIPE)
     except:  # Windows
         s = subprocess.Popen(['tasklist', '/v'], stdout=subprocess.PIPE)
@@ -109,70 +171,221 @@ def is_running(process):
     return process in str(process_list)
 
 
-def set_wallpaper(image, desktop_env):
+def record_backend_timing(desktop_env, duration):
+    timing = backend_timings.setdefault(desktop_env, {'calls': 0, 'total': 0.0, 'last': 0.0, 'max': 0.0})
+
+    timing['calls'] += 1
+    timing['total'] += duration
+    timing['last'] = duration
+    timing['max'] = max(timing['max'], duration)
+
 
-    if desktop_env in ['gnome', 'unity', 'cinnamon', 'pantheon']:
+def run_command(args, timeout=COMMAND_TIMEOUT, input=None):
+    # Run a command directly (no shell) and wait for it, so that no zombies
+    # are left behind. Returns whether it succeeded, and raises OSError if it
+    # could not be started at all (e.g. not installed).
 
-        uri = 'file://%s' % image
+    try:
+        process = subprocess.run(args, input=input, timeout=timeout)
 
+    except subprocess.TimeoutExpired:
+        # run() has already killed and reaped it
+        sys.stderr.write('Error: %s timed out after %d seconds.\n' % (args[0], timeout))
+        return False
+
+    if process.returncode != 0:
+        sys.stderr.write('Error: %s failed with exit status %d.\n' % (args[0], process.returncode))
+        return False
+
+    return True
+
+
+def run_commands(commands, timeout=COMMAND_TIMEOUT):
+    for args in commands:
+        if not run_command(args, timeout):
+            return False
+
+    return True
+
+
+def run_commands_concurrently(commands, timeout=COMMAND_TIMEOUT):
+    # Start all the commands at once, then wait for (and reap) every one
+
+    processes = [(args, subprocess.Popen(args)) for args in commands]
+    deadline = time.monotonic() + timeout
+    success = True
+
+    for args, process in processes:
         try:
-            from gi.repository import Gio
-            SCHEMA = 'org.gnome.desktop.background'
-            KEY = 'picture-uri'
-            gsettings = Gio.Settings.new(SCHEMA)
+            returncode = process.wait(timeout=max(0, deadline - time.monotonic()))
 
-            gsettings.set_string(KEY, uri)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            sys.stderr.write('Error: %s timed out after %d seconds.\n' % (args[0], timeout))
+            success = False
+            continue
 
-        except:
-            args = ['gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', uri]
-            subprocess.Popen(args)
+        if returncode != 0:
+            sys.stderr.write('Error: %s failed with exit status %d.\n' % (args[0], returncode))
+            success = False
 
-    elif desktop_env == 'mate':
+    return success
 
-        try:  # MATE >= 1.6
-            args = ['gsettings', 'set', 'org.mate.background', 'picture-filename', '%s' % image]
-            subprocess.Popen(args)
 
-        except:  # MATE < 1.6
-            args = ['mateconftool-2', '-t', 'string', '--set', '/desktop/mate/background/picture_filename',
-                    '%s' % image]
-            subprocess.Popen(args)
+def get_command_output(args, timeout=COMMAND_TIMEOUT):
+    try:
+        process = subprocess.run(args, stdout=subprocess.PIPE, timeout=timeout)
+
+    except subprocess.TimeoutExpired:
+        sys.stderr.write('Error: %s timed out after %d seconds.\n' % (args[0], timeout))
+        return ''
+
+    return process.stdout.decode('utf-8')
+
+
+def get_wallpaper_commands(image, desktop_env):
+    # The commands that set the wallpaper, for desktops where running them is
+    # all there is to it. None for the others.
+
+    if desktop_env in GNOME_DESKTOPS:
+        return [['gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', 'file://%s' % image]]
+
+    elif desktop_env == 'mate':  # MATE >= 1.6
+        return [['gsettings', 'set', 'org.mate.background', 'picture-filename', '%s' % image]]
 
     elif desktop_env == 'gnome2':
-        args = ['gconftool-2', '-t', 'string', '--set', '/desktop/gnome/background/picture_filename', '%s' % image]
-        subprocess.Popen(args)
+        return [['gconftool-2', '-t', 'string', '--set', '/desktop/gnome/background/picture_filename', '%s' % image]]
 
     elif desktop_env == 'kde':
-        kde_script = dedent(
-            '''\
-            var Desktops = desktops();
-            for (i=0;i<Desktops.length;i++) {
-                d = Desktops[i];
-                d.wallpaperPlugin = "org.kde.image";
-                d.currentConfigGroup = Array("Wallpaper",
-                                            "org.kde.image",
-                                            "General");
-                d.writeConfig("Image", "file://%s")
-            }
-            ''') % image
-
-        subprocess.Popen(
-            ['dbus-send',
-             '--session',
-             '--dest=org.kde.plasmashell',
-             '--type=method_call',
-             '/PlasmaShell',
-             'org.kde.PlasmaShell.evaluateScript',
-             'string:{}'.format(kde_script)]
-        )
+        return [['dbus-send',
+                 '--session',
+                 '--dest=org.kde.plasmashell',
+                 '--type=method_call',
+                 '/PlasmaShell',
+                 'org.kde.PlasmaShell.evaluateScript',
+                 'string:{}'.format(KDE_SCRIPT % image)]]
 
     elif desktop_env in ['kde3', 'trinity']:
+        return [['dcop', 'kdesktop', 'KBackgroundIface', 'setWallpaper', '0', image, '6']]
+
+    elif desktop_env in ['fluxbox', 'jwm', 'openbox', 'afterstep', 'i3']:
+        return [['feh', '--bg-scale', image]]
+
+    elif desktop_env == 'icewm':
+        return [['icewmbg', image]]
+
+    elif desktop_env == 'blackbox':
+        return [['bsetbg', '-full', image]]
+
+    elif desktop_env == 'lxde':
+        return [['pcmanfm', '--set-wallpaper', image, '--wallpaper-mode=scaled']]
+
+    elif desktop_env == 'lxqt':
+        return [['pcmanfm-qt', '--set-wallpaper', image, '--wallpaper-mode=scaled']]
+
+    elif desktop_env == 'windowmaker':
+        return [['wmsetbg', '-s', '-u', image]]
+
+    elif desktop_env == 'enlightenment':
+        return [['enlightenment_remote', '-desktop-bg-add', '0', '0', '0', '0', image]]
+
+    return None
+
+
+class Backend:
+    # Sets the wallpaper on one desktop. Only one is made per desktop and
+    # session (see get_backend()), so anything it connects to stays open
+    # from one wallpaper change to the next.
+
+    def __init__(self, desktop_env):
+        self.desktop_env = desktop_env
+
+    def get_commands(self, image):
+        # None if the wallpaper is not set by just running commands
+        return get_wallpaper_commands(image, self.desktop_env)
+
+    def set_wallpaper(self, image):
+        return apply_wallpaper(image, self.desktop_env)
+
+
+class GnomeBackend(Backend):
+
+    def __init__(self, desktop_env):
+        super().__init__(desktop_env)
+
+        try:
+            from gi.repository import Gio
+            self.settings = Gio.Settings.new('org.gnome.desktop.background')
+            self.sync_settings = Gio.Settings.sync
+
+        except Exception:  # No PyGObject, use gsettings instead
+            self.settings = None
+
+    def get_commands(self, image):
+        if self.settings is not None:
+            return None
+
+        return super().get_commands(image)
+
+    def set_wallpaper(self, image):
+        if self.settings is None:
+            return run_commands(self.get_commands(image))
+
+        self.settings.set_string('picture-uri', 'file://%s' % image)
+
+        # Nothing runs a main loop for us to write it out later
+        self.sync_settings()
+
+        return True
+
+
+class DBusBackend(Backend):
+    # For desktops with a D-Bus interface: the session bus connection is made
+    # once and kept, falling back to the desktop's commands without PyGObject
+
+    def __init__(self, desktop_env):
+        super().__init__(desktop_env)
+
+        try:
+            from gi.repository import Gio, GLib
+            self.bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            self.Gio, self.GLib = Gio, GLib
+
+        except Exception:
+            self.bus = None
+
+    def call(self, name, path, interface, method, parameters):
+        return self.bus.call_sync(name, path, interface, method, parameters,
+                                  None, self.Gio.DBusCallFlags.NONE, COMMAND_TIMEOUT * 1000, None)
+
+
+class KdeBackend(DBusBackend):
 
-        args = 'dcop kdesktop KBackgroundIface setWallpaper 0 "%s" 6' % image
-        subprocess.Popen(args, shell=True)
+    def get_commands(self, image):
+        if self.bus is not None:
+            return None
 
-    elif desktop_env == 'xfce4':
+        return super().get_commands(image)
 
+    def set_wallpaper(self, image):
+        if self.bus is None:
+            return run_commands(self.get_commands(image))
+
+        self.call('org.kde.plasmashell', '/PlasmaShell', 'org.kde.PlasmaShell', 'evaluateScript',
+                  self.GLib.Variant('(s)', (KDE_SCRIPT % image,)))
+
+        return True
+
+
+class XfceBackend(DBusBackend):
+
+    def __init__(self, desktop_env):
+        super().__init__(desktop_env)
+
+        self.properties = []
+
+    def get_properties(self):
         # XFCE4's image property is not image-path but last-image (What?)
         # Only GNOME seems to have a sane wallpaper interface
 
@@ -180,24 +393,90 @@ def set_wallpaper(image, desktop_env):
         # XFCE 4.12 to just monitor0 instead of monitorVGA1 or something
         # So now we need to do both.
 
-        list_of_properties_cmd = subprocess.Popen(['bash -c "xfconf-query -R -l -c xfce4-desktop -p /backdrop"'],
-                                                  shell=True, stdout=subprocess.PIPE)
+        if not self.properties:
+            list_of_properties = get_command_output(
+                ['xfconf-query', '-R', '-l', '-c', 'xfce4-desktop', '-p', '/backdrop'])
+
+            self.properties = [i for i in list_of_properties.split('\n') if i.endswith('last-image')]
+
+        return self.properties
+
+    def set_properties_over_dbus(self, image):
+        # All the properties through our own connection, without forking an
+        # xfconf-query for each of them
+
+        for i in self.get_properties():
+            self.call('org.xfce.Xfconf', '/org/xfce/Xfconf', 'org.xfce.Xfconf', 'SetProperty',
+                      self.GLib.Variant('(ssv)', ('xfce4-desktop', i, self.GLib.Variant('s', image))))
+
+    def set_wallpaper(self, image):
+        try:
+            if self.bus is None:
+                raise ImportError('No PyGObject')
+
+            self.set_properties_over_dbus(image)
+
+        except Exception:
+            # No PyGObject or no xfconfd on the bus, set them all in one go
+            success = run_commands_concurrently(
+                [['xfconf-query', '-c', 'xfce4-desktop', '-p', i, '-s', image] for i in self.get_properties()])
+
+            if not success:
+                # Monitors may have come and gone, list the properties again next time
+                self.properties = []
+                return False
+
+        # Reload only once, after all the properties are set
+        return run_command(['xfdesktop', '--reload'])
+
+
+def get_backend(desktop_env):
+    if desktop_env not in backends:
+        if desktop_env in GNOME_DESKTOPS:
+            backends[desktop_env] = GnomeBackend(desktop_env)
+        elif desktop_env == 'kde':
+            backends[desktop_env] = KdeBackend(desktop_env)
+        elif desktop_env == 'xfce4':
+            backends[desktop_env] = XfceBackend(desktop_env)
+        else:
+            backends[desktop_env] = Backend(desktop_env)
+
+    return backends[desktop_env]
+
 
-        list_of_properties, list_of_properties_err = list_of_properties_cmd.communicate()
+def set_wallpaper(image, desktop_env):
+    # Times each desktop's wallpaper change, see backend_timings
+
+    start = time.monotonic()
+
+    try:
+        return get_backend(desktop_env).set_wallpaper(image)
 
-        list_of_properties = list_of_properties.decode('utf-8')
+    finally:
+        record_backend_timing(desktop_env, time.monotonic() - start)
 
-        for i in list_of_properties.split('\n'):
-            if i.endswith('last-image'):
-                # The property given is a background property
-                subprocess.Popen(
-                    ['xfconf-query -c xfce4-desktop -p %s -s "%s"' % (i, image)],
-                    shell=True)
 
-                subprocess.Popen(['xfdesktop --reload'], shell=True)
+def apply_wallpaper(image, desktop_env):
+    # Desktops that need no Backend of their own
+
+    if desktop_env == 'mate':
+
+        try:  # MATE >= 1.6
+            return run_commands(get_wallpaper_commands(image, desktop_env))
+
+        except OSError:  # MATE < 1.6
+            args = ['mateconftool-2', '-t', 'string', '--set', '/desktop/mate/background/picture_filename',
+                    '%s' % image]
+            return run_command(args)
+
+    elif desktop_env in ['gnome2', 'kde3', 'trinity', 'icewm', 'blackbox',
+                         'lxde', 'lxqt', 'windowmaker', 'enlightenment']:
+        return run_commands(get_wallpaper_commands(image, desktop_env))
 
     elif desktop_env == 'razor-qt':
 
+        import configparser
+
         desktop_conf = configparser.ConfigParser()
         # Development version
 
@@ -224,53 +503,24 @@ def set_wallpaper(image, desktop_env):
     elif desktop_env in ['fluxbox', 'jwm', 'openbox', 'afterstep', 'i3']:
 
         try:
-            args = ['feh', '--bg-scale', image]
-            subprocess.Popen(args)
-        except:
+            return run_commands(get_wallpaper_commands(image, desktop_env))
+        except OSError:
             sys.stderr.write('Error: Failed to set wallpaper with feh!')
             sys.stderr.write('Please make sre that You have feh installed.')
-
-    elif desktop_env == 'icewm':
-
-        args = ['icewmbg', image]
-        subprocess.Popen(args)
-
-    elif desktop_env == 'blackbox':
-
-        args = ['bsetbg', '-full', image]
-        subprocess.Popen(args)
-
-    elif desktop_env == 'lxde':
-
-        args = 'pcmanfm --set-wallpaper %s --wallpaper-mode=scaled' % image
-        subprocess.Popen(args, shell=True)
-
-    elif desktop_env == 'lxqt':
-
-        args = 'pcmanfm-qt --set-wallpaper %s --wallpaper-mode=scaled' % image
-        subprocess.Popen(args, shell=True)
-
-    elif desktop_env == 'windowmaker':
-
-        args = 'wmsetbg -s -u %s' % image
-        subprocess.Popen(args, shell=True)
-
-    elif desktop_env == 'enlightenment':
-
-        args = 'enlightenment_remote -desktop-bg-add 0 0 0 0 %s' % image
-        subprocess.Popen(args, shell=True)
+            return False
 
     elif desktop_env == 'awesome':
 
-        with subprocess.Popen("awesome-client", stdin=subprocess.PIPE) as awesome_client:
-            command = 'local gears = require("gears"); for s = 1, screen.count() do gears.wallpaper.maximized("%s", s, true); end;' % image
-            awesome_client.communicate(input=bytes(command, 'UTF-8'))
+        command = 'local gears = require("gears"); for s = 1, screen.count() do gears.wallpaper.maximized("%s", s, true); end;' % image
+        return run_command(['awesome-client'], input=bytes(command, 'UTF-8'))
 
     elif desktop_env == 'windows':
 
         # Update Windows Registry and Force Desktop Reload
-        os.system('''reg add "HKEY_CURRENT_USER\Control Panel\Desktop" /v Wallpaper /t REG_SZ /d  %s /f''' % image)
-        os.system('''RUNDLL32.EXE USER32.DLL,UpdatePerUserSystemParameters 1, True''')
+        return run_commands([
+            ['reg', 'add', r'HKEY_CURRENT_USER\Control Panel\Desktop', '/v', 'Wallpaper', '/t', 'REG_SZ',
+             '/d', image, '/f'],
+            ['RUNDLL32.EXE', 'USER32.DLL,UpdatePerUserSystemParameters', '1,', 'True']])
 
     elif desktop_env == 'mac':
 
@@ -289,16 +539,10 @@ def set_wallpaper(image, desktop_env):
                                 end tell
             ''' % image
 
-            osx_script_file = open(os.path.expanduser('~/.weatherdesk_script.AppleScript'), 'w')
-            osx_script_file.truncate()
-
-            osx_script_file = open(os.path.expanduser('~/.weatherdesk_script.AppleScript'), 'w')
-            osx_script_file.truncate()
+            with open(os.path.expanduser('~/.weatherdesk_script.AppleScript'), 'w') as osx_script_file:
+                osx_script_file.write(OSX_SCRIPT)
 
-            osx_script_file.write(OSX_SCRIPT)
-            osx_script_file.close()
-
-            subprocess.Popen(
+            return run_command(
                 ['/usr/bin/osascript', os.path.abspath(os.path.expanduser('~/.weatherdesk_script.AppleScript'))])
 
     else:
@@ -309,6 +553,61 @@ def set_wallpaper(image, desktop_env):
     return True
 
 
+async def set_wallpaper_async(image, desktop_env, timeout=COMMAND_TIMEOUT):
+    start = time.monotonic()
+
+    try:
+        return await apply_wallpaper_async(image, desktop_env, timeout)
+
+    finally:
+        record_backend_timing(desktop_env, time.monotonic() - start)
+
+
+async def apply_wallpaper_async(image, desktop_env, timeout=COMMAND_TIMEOUT):
+    # Like Backend.set_wallpaper(), but commands are awaited without blocking the
+    # event loop, and killed if they take longer than timeout
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    backend = get_backend(desktop_env)
+
+    commands = backend.get_commands(image)
+
+    if commands is None:
+        # Done in-process (or not just a command), leave it to the backend
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(None, backend.set_wallpaper, image), timeout)
+
+        except asyncio.TimeoutError:
+            sys.stderr.write('Error: Setting the wallpaper timed out after %d seconds.\n' % timeout)
+            return False
+
+    for args in commands:
+        try:
+            process = await asyncio.create_subprocess_exec(*args)
+
+        except OSError:
+            # Not installed, let the backend try the alternatives
+            return await loop.run_in_executor(None, backend.set_wallpaper, image)
+
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            sys.stderr.write('Error: %s timed out after %d seconds.\n' % (args[0], timeout))
+            return False
+
+        if process.returncode != 0:
+            sys.stderr.write('Error: %s failed with exit status %d.\n' % (args[0], process.returncode))
+            return False
+
+    return True
+
+
 def get_config_dir(app_name):
     if 'XDG_CONFIG_HOME' in os.environ:
         confighome = os.environ['XDG_CONFIG_HOME']
@@ -327,3 +626,23 @@ def get_config_dir(app_name):
     configdir = os.path.join(confighome, app_name)
 
     return configdir
+
+
+def get_cache_dir(app_name):
+    if 'XDG_CACHE_HOME' in os.environ:
+        cachehome = os.environ['XDG_CACHE_HOME']
+
+    elif 'LOCALAPPDATA' in os.environ:  # On Windows
+        cachehome = os.environ['LOCALAPPDATA']
+
+    else:
+        try:
+            from xdg import BaseDirectory
+            cachehome = BaseDirectory.xdg_cache_home
+
+        except ImportError:  # Most likely a Linux/Unix system anyway
+            cachehome = os.path.join(os.path.expanduser('~'), '.cache')
+
+    cachedir = os.path.join(cachehome, app_name)
+
+    return cachedir
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+import shlex
+from xml.sax.saxutils import escape
+
+
+# A whole day's wallpapers, written out for the desktop (or the system) to
+# change on its own, so that nothing has to keep running for wallpapers that
+# only follow the time of day
+
+MINUTES_PER_DAY = 24 * 60
+
+SLIDESHOW_FILE = 'weatherdesk.xml'
+SERVICE_FILE = 'weatherdesk.service'
+TIMER_FILE = 'weatherdesk.timer'
+CRONTAB_FILE = 'weatherdesk.crontab'
+
+
+def get_slides(schedule, get_image):
+    # [(start, minutes, image)] over the day from midnight, for a Schedule and
+    # get_image(time of day). Times of day with the same image are merged.
+
+    periods = list(zip(schedule.starts, schedule.labels))
+
+    if periods[0][0] != 0:
+        # Still the last time of day from the day before
+        periods.insert(0, (0, schedule.labels[-1]))
+
+    slides = []
+
+    for (start, label), end in zip(periods, [i[0] for i in periods[1:]] + [MINUTES_PER_DAY]):
+        image = get_image(label)
+
+        if slides and slides[-1][2] == image:
+            slides[-1] = (slides[-1][0], slides[-1][1] + end - start, image)
+        else:
+            slides.append((start, end - start, image))
+
+    return slides
+
+
+def get_changes(slides):
+    # The minutes of the day at which the image changes
+
+    return [start for (start, minutes, image), previous in zip(slides, slides[-1:] + slides[:-1])
+            if image != previous[2]]
+
+
+def format_slideshow(slides, date):
+    # A GNOME background XML slideshow, starting at midnight on date and
+    # going round once a day. (MATE and Cinnamon take them too.) Durations
+    # are in seconds, so after a DST change it is an hour off until
+    # exported again.
+
+    lines = ['<background>',
+             '  <starttime>',
+             '    <year>{}</year>'.format(date.year),
+             '    <month>{}</month>'.format(date.month),
+             '    <day>{}</day>'.format(date.day),
+             '    <hour>0</hour>',
+             '    <minute>0</minute>',
+             '    <second>0</second>',
+             '  </starttime>']
+
+    for start, minutes, image in slides:
+        lines += ['  <static>',
+                  '    <duration>{:.1f}</duration>'.format(minutes * 60),
+                  '    <file>{}</file>'.format(escape(image)),
+                  '  </static>']
+
+    lines.append('</background>')
+
+    return '\n'.join(lines) + '\n'
+
+
+def join_command(command):
+    return ' '.join(shlex.quote(i) for i in command)
+
+
+def format_service(command):
+    # A systemd user service running command once
+
+    return '\n'.join(['[Unit]',
+                      'Description=Set the wallpaper for the time of day',
+                      '',
+                      '[Service]',
+                      'Type=oneshot',
+                      'ExecStart={}'.format(join_command(command))]) + '\n'
+
+
+def format_timer(changes):
+    # A systemd user timer starting the service at each of changes (minutes
+    # of the day), and when it missed one (while suspended or switched off)
+
+    return '\n'.join(['[Unit]',
+                      'Description=Change the wallpaper when the time of day changes',
+                      '',
+                      '[Timer]'] +
+                     ['OnCalendar=*-*-* {:02d}:{:02d}:00'.format(*divmod(i, 60)) for i in changes] +
+                     ['Persistent=true',
+                      '',
+                      '[Install]',
+                      'WantedBy=timers.target']) + '\n'
+
+
+def format_crontab(changes, command):
+    # crontab lines running command at each of changes (minutes of the day)
+
+    return ''.join('{} {} * * * {}\n'.format(minute, hour, join_command(command))
+                   for hour, minute in (divmod(i, 60) for i in changes))
+
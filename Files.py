@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+
+
+# Files replaced in one go: written to a temporary file next to them, then
+# renamed over them, so that nothing (another instance, the desktop, a
+# metrics scraper) ever reads half of one, and a crash leaves the old one
+
+
+def replace_file(path, write, binary=False):
+    # Write path with write(f). The temporary file is named after this
+    # process and thread, and starts with a dot so it is easy to skip.
+
+    directory, file_name = os.path.split(os.path.abspath(path))
+
+    temp_file = os.path.join(directory, '.{}.{}.{}.tmp'.format(file_name, os.getpid(), threading.get_ident()))
+
+    try:
+        with open(temp_file, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as f:
+            write(f)
+
+        os.replace(temp_file, path)
+
+    except BaseException:
+        # Whatever failed (opening it too), that is the error to report
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+        raise
+
+
+def write_text(path, text):
+    replace_file(path, lambda f: f.write(text))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import http.client
+import io
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+# Small shared HTTP client - keeps one connection open per host, so that
+# every update does not pay for DNS, TCP and TLS handshakes again
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+MAX_REDIRECTS = 5
+
+USER_AGENT = 'WeatherDesk'
+
+# Open connections, keyed by (scheme, host, port)
+connections = {}
+
+
+def get_connection(scheme, host, port):
+    key = (scheme, host, port)
+
+    if key not in connections:
+        if scheme == 'https':
+            connections[key] = http.client.HTTPSConnection(host, port, timeout=CONNECT_TIMEOUT)
+        elif scheme == 'http':
+            connections[key] = http.client.HTTPConnection(host, port, timeout=CONNECT_TIMEOUT)
+        else:
+            raise urllib.error.URLError('Unsupported URL scheme %s' % scheme)
+
+    return connections[key]
+
+
+def close_connections():
+    for connection in connections.values():
+        connection.close()
+
+    connections.clear()
+
+
+def send_request(url, headers):
+    parts = urllib.parse.urlsplit(url)
+
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    connection = get_connection(parts.scheme, parts.hostname, parts.port)
+
+    # A kept-alive connection may have been closed by the server since we
+    # last used it, in which case we reconnect once and try again
+    for attempt in range(2):
+        reused = connection.sock is not None
+
+        try:
+            if not reused:
+                connection.connect()
+                connection.sock.settimeout(READ_TIMEOUT)
+
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+
+        except (http.client.RemoteDisconnected, http.client.ImproperConnectionState,
+                ConnectionResetError, BrokenPipeError) as e:
+            connection.close()
+
+            if not reused:
+                raise urllib.error.URLError(e)
+
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise urllib.error.URLError(e)
+
+    raise urllib.error.URLError('Connection to %s keeps closing' % parts.hostname)
+
+
+def read_json(response):
+    # Decompress and decode as the body comes in, so that no copy of the raw
+    # (compressed) body is kept. json.load() still reads the whole text
+    # before parsing it.
+
+    if response.getheader('Content-Encoding', '').lower() == 'gzip':
+        body = gzip.GzipFile(fileobj=response)
+    else:
+        body = response
+
+    text = io.TextIOWrapper(body, encoding='utf-8')
+
+    try:
+        return json.load(text)
+
+    except (OSError, http.client.HTTPException) as e:
+        raise urllib.error.URLError(e)
+
+    finally:
+        # Do not let the wrapper close the response along with itself
+        text.detach()
+
+
+def get_json_with_proxy(url, headers):
+    # Our connections do not speak to proxies, leave those to urllib
+
+    request = urllib.request.Request(url, headers=headers)
+
+    try:
+        response = urllib.request.urlopen(request, timeout=READ_TIMEOUT)
+
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return e.code, e.headers, None
+        raise
+
+    with response:
+        return response.status, response.headers, read_json(response)
+
+
+def get_json(url, headers=None):
+    # Returns (status, headers, decoded JSON). The JSON is None for a
+    # 304 Not Modified, and errors are raised as urllib.error exceptions so
+    # callers can handle them just like with urlopen().
+
+    request_headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    request_headers.update(headers or {})
+
+    if urllib.request.getproxies().get(urllib.parse.urlsplit(url).scheme):
+        return get_json_with_proxy(url, request_headers)
+
+    for redirect in range(MAX_REDIRECTS + 1):
+        response = send_request(url, request_headers)
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            response.read()
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+            continue
+
+        if response.status == 304:
+            response.read()
+            return response.status, response.headers, None
+
+        if response.status >= 400:
+            response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+        data = read_json(response)
+
+        # Drain whatever is left so that the connection can be reused
+        response.read()
+
+        return response.status, response.headers, data
+
+    raise urllib.error.URLError('Too many redirects for %s' % url)
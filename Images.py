@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import re
+import subprocess
+import sys
+
+import Files
+
+
+# Copies of the wallpapers scaled down to the screen, so the desktop does not
+# have to decode and scale a huge image on every change. Needs Pillow, without
+# it (or without a known screen size) the original images are used.
+
+# Cached result of get_screen_resolution()
+screen_resolution = {}
+
+
+def detect_screen_resolution():
+    # (width, height) of the largest monitor, or None if unknown
+
+    if sys.platform in ['win32', 'cygwin']:
+        try:
+            import ctypes
+            user32 = ctypes.windll.user32
+            return user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
+        except (ImportError, AttributeError, OSError):
+            return None
+
+    try:
+        xrandr = subprocess.run(['xrandr', '--current'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    # e.g. "HDMI-1 connected primary 1920x1080+0+0 (normal left ...) ..."
+    monitors = re.findall(r' connected (?:primary )?(\d+)x(\d+)\+', xrandr.stdout.decode('utf-8', 'replace'))
+
+    if not monitors:
+        return None
+
+    return max((int(width), int(height)) for width, height in monitors)
+
+
+def get_screen_resolution():
+    if 'resolution' not in screen_resolution:
+        screen_resolution['resolution'] = detect_screen_resolution()
+
+    return screen_resolution['resolution']
+
+
+def evict_scaled_images(cache_dir, max_cache_size):
+    # Delete the least recently used images until the cache fits max_cache_size
+    # (bytes). get_scaled_image() touches an image whenever it is used.
+
+    images = []
+
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                images.append((stat.st_mtime, stat.st_size, entry.path))
+
+    cache_size = sum(size for mtime, size, path in images)
+
+    for mtime, size, path in sorted(images):
+        if cache_size <= max_cache_size:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        cache_size -= size
+
+
+def scale_image(image, scaled_image, resolution):
+    # Scale image to cover the screen (most desktops zoom or fill), keeping
+    # its aspect ratio. Returns False if it is small enough already (or would
+    # have to be scaled up).
+
+    from PIL import Image
+
+    width, height = resolution
+
+    with Image.open(image) as source:
+        # Only ever scaled down: an image that does not cover the screen on
+        # one side (however large on the other) is used as it is
+        if max(width / source.width, height / source.height) >= 1:
+            return False
+
+        # Lets JPEGs be decoded at a fraction of their size to begin with
+        source.draft('RGB', (width, height))
+
+        ratio = max(width / source.width, height / source.height)
+
+        scaled = source.resize((max(1, round(source.width * ratio)), max(1, round(source.height * ratio))),
+                               Image.LANCZOS)
+
+        if scaled_image.lower().endswith(('.jpg', '.jpeg')) and scaled.mode not in ['RGB', 'L']:
+            scaled = scaled.convert('RGB')
+
+        # The temporary file starts with a dot, evict_scaled_images() leaves it be
+        Files.replace_file(scaled_image, lambda f: scaled.save(f, format=source.format), binary=True)
+
+    return True
+
+
+def get_scaled_image(image, cache_dir, max_cache_size):
+    # The path of image scaled to the screen, or image itself if it cannot
+    # (or need not) be scaled
+
+    resolution = get_screen_resolution()
+
+    if resolution is None:
+        return image
+
+    try:
+        import PIL
+    except ImportError:
+        return image
+
+    try:
+        mtime = os.stat(image).st_mtime_ns
+    except OSError:
+        return image
+
+    key = '{}\0{}\0{}x{}'.format(image, mtime, *resolution)
+
+    scaled_image = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() +
+                                os.path.splitext(image)[1].lower())
+
+    if os.path.isfile(scaled_image):
+        os.utime(scaled_image)
+        return scaled_image
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    try:
+        if not scale_image(image, scaled_image, resolution):
+            return image
+
+    except Exception as e:  # Unsupported format, broken image, ...
+        sys.stderr.write('Could not scale {}: {}\n'.format(image, e))
+        return image
+
+    evict_scaled_images(cache_dir, max_cache_size)
+
+    if not os.path.isfile(scaled_image):  # Too big for the cache on its own
+        return image
+
+    return scaled_image
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import sys
+import threading
+import time
+
+import Files
+
+from itertools import accumulate
+
+
+# Counters and histograms of what the updates do, written out after each
+# update to a file: in the Prometheus text format (e.g. for node_exporter's
+# textfile collector) or as JSON.
+#
+# Recording is a few dict updates, so it is always done, whether or not the
+# metrics are written anywhere.
+
+PREFIX = 'weatherdesk_'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+DESCRIPTIONS = {
+    'updates_total': 'Wallpaper updates, by result.',
+    'errors_total': 'Failed wallpaper updates, by exception class.',
+    'weather_cache_total': 'Weather lookups, by whether the cached weather was used.',
+    'weather_refresh_total': 'Weather fetches in the background, by result.',
+    'wallpaper_changes_total': 'Wallpapers set, by result.',
+    'duration_seconds': 'Time taken by each stage of an update.',
+    'last_update_timestamp_seconds': 'When the last update finished.',
+}
+
+# Updates come from the asyncio loop's worker threads too
+lock = threading.Lock()
+
+# Keyed by (name, labels), labels being a tuple of (label, value) pairs
+counters = {}
+gauges = {}
+
+# Same keys, values are {'buckets': [count per bucket, +Inf last], 'sum', 'count'}
+histograms = {}
+
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = get_key(name, labels)
+
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[get_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    key = get_key(name, labels)
+
+    with lock:
+        if key not in histograms:
+            histograms[key] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+
+        histogram = histograms[key]
+
+        histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        histogram['last'] = seconds
+
+
+class Timer:
+    # with Timer('weather'): ... records how long the block took, even if it
+    # raises, as a stage of the update
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe('duration_seconds', time.monotonic() - self.start, stage=self.stage)
+
+
+def get_last_durations():
+    # {stage: seconds} the last time each stage ran
+
+    with lock:
+        return {dict(labels)['stage']: histogram['last']
+                for (name, labels), histogram in histograms.items() if name == 'duration_seconds'}
+
+
+def record_update(error=None):
+    # error is the exception class an update failed with, if it did
+
+    if error is None:
+        increment('updates_total', result='ok')
+    else:
+        increment('updates_total', result='error')
+        increment('errors_total', **{'class': error.__name__})
+
+    set_gauge('last_update_timestamp_seconds', time.time())
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for label, value in labels) + '}'
+
+
+def format_prometheus():
+    lines = []
+    described = set()
+
+    def describe(name, metric_type):
+        if name not in described:
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, DESCRIPTIONS.get(name, name)))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+            described.add(name)
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, 'counter')
+        lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels), value))
+
+    for (name, labels), value in sorted(gauges.items()):
+        describe(name, 'gauge')
+        lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels), value))
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, 'histogram')
+
+        cumulative = 0
+
+        for bound, count in zip(BUCKETS + ['+Inf'], histogram['buckets']):
+            cumulative += count
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(labels, [('le', bound)]),
+                                                   cumulative))
+
+        lines.append('{}{}_sum{} {}'.format(PREFIX, name, format_labels(labels), histogram['sum']))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_json():
+    stats = {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+    for kind, metrics in [('counters', counters), ('gauges', gauges)]:
+        for (name, labels), value in sorted(metrics.items()):
+            stats[kind].setdefault(PREFIX + name, []).append({'labels': dict(labels), 'value': value})
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        stats['histograms'].setdefault(PREFIX + name, []).append({
+            'labels': dict(labels),
+            # Cumulative, like Prometheus' le buckets
+            'buckets': dict(zip([str(i) for i in BUCKETS] + ['+Inf'], accumulate(histogram['buckets']))),
+            'sum': histogram['sum'],
+            'count': histogram['count'],
+        })
+
+    return json.dumps(stats, indent=2) + '\n'
+
+
+def write(metrics_file):
+    # As JSON if metrics_file ends with .json, in the Prometheus text format
+    # otherwise. Replaced in one go, so that nothing reads half a file.
+
+    with lock:
+        if metrics_file.lower().endswith('.json'):
+            text = format_json()
+        else:
+            text = format_prometheus()
+
+    try:
+        Files.write_text(metrics_file, text)
+
+    except OSError as e:
+        sys.stderr.write('Could not write metrics to {}: {}\n'.format(metrics_file, e))
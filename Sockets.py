@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import socket
+import socketserver
+
+
+# Local services over Unix sockets: one JSON object per line each way, a
+# request and its answer per connection
+
+REQUEST_TIMEOUT = 60
+
+# Longest request or answer, in bytes
+MAX_MESSAGE = 65536
+
+
+def request(socket_path, message, timeout=REQUEST_TIMEOUT):
+    # Send message to the server at socket_path and return its answer.
+    # Raises OSError if it cannot be reached, and ValueError for an answer
+    # that is not JSON.
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with connection.makefile('rb') as f:
+            answer = f.readline(MAX_MESSAGE)
+
+    if not answer:
+        raise ConnectionResetError('{} closed the connection without answering'.format(socket_path))
+
+    return json.loads(answer.decode('utf-8'))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline(MAX_MESSAGE).decode('utf-8'))
+
+            if not isinstance(message, dict):
+                raise ValueError('Expected a JSON object')
+
+            answer = self.server.answer(message)
+
+        except Exception as e:  # Tell the client, and keep serving the others
+            answer = {'error': '{}: {}'.format(type(e).__name__, e)}
+
+        try:
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+        except OSError:  # Client gone
+            pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Calls answer(message) for each request, in a thread of its own, and
+    # sends back what it returns
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, answer, mode=0o600):
+        self.answer = answer
+
+        remove_stale_socket(socket_path)
+
+        if os.path.dirname(socket_path):
+            os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+        super().__init__(socket_path, RequestHandler)
+
+        os.chmod(socket_path, mode)
+
+    def server_close(self):
+        super().server_close()
+
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def remove_stale_socket(socket_path):
+    # Left behind by a server that did not exit cleanly. Raises OSError if
+    # a server is still listening on it.
+
+    if not os.path.exists(socket_path):
+        return
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+
+    except OSError:
+        os.remove(socket_path)
+        return
+
+    raise OSError('Another server is already listening on {}'.format(socket_path))
+
+
+def serve(socket_path, answer, mode=0o600):
+    server = Server(socket_path, answer, mode)
+
+    try:
+        server.serve_forever()
+
+    finally:
+        server.server_close()
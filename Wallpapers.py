@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import Watch
+
+
+# Index of the wallpaper directory, from wallpaper name (file name without
+# extension) to the images for it. Kept up to date by watching the directory,
+# so files can be added, removed or renamed while WeatherDesk runs.
+#
+# A name can have a pool of images to rotate through: besides name.jpg,
+# name-<anything>.jpg and every image in a name/ directory.
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.svg']
+
+# The parts wallpaper names are made of. "day-rain-2" is in the pool for
+# "day-rain", but not in the one for "day".
+NAME_PARTS = ['morning', 'day', 'evening', 'night',
+              'rain', 'snow', 'normal', 'cloudy', 'wind', 'thunder']
+
+ROTATIONS = ['shuffle', 'order']
+
+# Indexes, keyed by (directory, preferred format)
+indexes = {}
+
+
+def scan_images(directory, preference):
+    # {name: path} of the images in directory, and the subdirectories in it.
+    # If the same name exists in several formats, the earliest one in
+    # preference wins.
+
+    images = {}
+    ranks = {}
+    subdirectories = []
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirectories.append(entry)
+                continue
+
+            name, extension = os.path.splitext(entry.name)
+            extension = extension.lower()
+
+            if extension not in preference or not entry.is_file():
+                continue
+
+            rank = preference.index(extension)
+
+            if name not in ranks or rank < ranks[name]:
+                images[name] = entry.path
+                ranks[name] = rank
+
+    return images, subdirectories
+
+
+def list_subdirectories(walls_dir):
+    with os.scandir(walls_dir) as entries:
+        return [entry.path for entry in entries if entry.is_dir()]
+
+
+def scan_wallpapers(walls_dir, file_format):
+    # One pass over the directory (and its pool directories). Returns the
+    # pools, {name: sorted list of paths}.
+
+    preference = [file_format.lower()] + [i for i in IMAGE_EXTENSIONS if i != file_format.lower()]
+
+    images, subdirectories = scan_images(walls_dir, preference)
+
+    pools = {}
+
+    for name, path in images.items():
+        parts = name.split('-')
+
+        for i in range(1, len(parts) + 1):
+            if i < len(parts) and parts[i] in NAME_PARTS:
+                continue
+
+            pools.setdefault('-'.join(parts[:i]), []).append(path)
+
+    for subdirectory in subdirectories:
+        pool_images, _ = scan_images(subdirectory.path, preference)
+        pools.setdefault(subdirectory.name, []).extend(pool_images.values())
+
+    for pool in pools.values():
+        pool.sort()
+
+    return pools
+
+
+class WallpaperIndex:
+
+    def __init__(self, walls_dir, file_format):
+        self.walls_dir = walls_dir
+        self.file_format = file_format
+
+        self.scan()
+
+    def scan(self):
+        # Watch before scanning, so nothing can slip in between. A pool
+        # directory made after listing them changes walls_dir, which is
+        # watched already.
+        self.watcher = Watch.Watcher([self.walls_dir] + list_subdirectories(self.walls_dir))
+        self.pools = scan_wallpapers(self.walls_dir, self.file_format)
+
+        # Rotation orders, keyed by name: (seed, order)
+        self.orders = {}
+
+    def refresh(self):
+        if self.watcher.changed():
+            self.watcher.close()
+            self.scan()
+
+    def get_pool(self, name):
+        self.refresh()
+        return self.pools.get(name, [])
+
+    def get(self, name):
+        # The path of a wallpaper called name, or None
+        pool = self.get_pool(name)
+        return pool[0] if pool else None
+
+    def get_order(self, name, pool, seed, rotation):
+        if rotation == 'order':
+            return pool
+
+        if name not in self.orders or self.orders[name][0] != seed:
+            import random
+
+            order = list(pool)
+            random.Random(seed).shuffle(order)
+            self.orders[name] = (seed, order)
+
+        return self.orders[name][1]
+
+    def choose(self, name, rotation, state, advance=True):
+        # The next wallpaper from the pool for name (the current one unless
+        # advance), or None. state holds where each pool is at, {name:
+        # {'seed', 'cursor', 'size', ...}}, and is updated so that the caller
+        # can keep it across restarts.
+
+        import random
+
+        pool = self.get_pool(name)
+
+        if len(pool) < 2:
+            return pool[0] if pool else None
+
+        pool_state = state.get(name)
+
+        if (not pool_state or pool_state.get('size') != len(pool) or
+                pool_state.get('rotation') != rotation):
+            # New or changed pool, start over
+            pool_state = {'seed': random.getrandbits(32), 'cursor': 0, 'size': len(pool), 'rotation': rotation}
+
+        elif advance:
+            last = self.get_order(name, pool, pool_state['seed'], rotation)[pool_state['cursor']]
+
+            pool_state['cursor'] += 1
+
+            if pool_state['cursor'] == len(pool):
+                pool_state['cursor'] = 0
+
+                if rotation == 'shuffle':
+                    # Shown them all, shuffle again - but do not start with
+                    # the one just shown
+                    pool_state['seed'] = random.getrandbits(32)
+
+                    while self.get_order(name, pool, pool_state['seed'], rotation)[0] == last:
+                        pool_state['seed'] = random.getrandbits(32)
+
+        state[name] = pool_state
+
+        return self.get_order(name, pool, pool_state['seed'], rotation)[pool_state['cursor']]
+
+    def close(self):
+        self.watcher.close()
+
+
+def get_index(walls_dir, file_format):
+    key = (walls_dir, file_format)
+
+    if key not in indexes:
+        indexes[key] = WallpaperIndex(walls_dir, file_format)
+
+    return indexes[key]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+
+# Notices changes to directories (or files) - through inotify on Linux, and
+# by comparing modification times everywhere else
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+def init_inotify(paths):
+    # A non-blocking inotify file descriptor watching paths, or None if
+    # inotify is not available
+
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if fd < 0:
+            return None
+
+        for path in paths:
+            if libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK) < 0:
+                os.close(fd)
+                return None
+
+        return fd
+
+    except (OSError, AttributeError):
+        return None
+
+
+def get_mtimes(paths):
+    mtimes = []
+
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+
+    return mtimes
+
+
+class Watcher:
+    # changed() tells whether anything happened to any of paths since it was
+    # last called
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+
+        self.fd = init_inotify(self.paths)
+
+        if self.fd is None:
+            self.mtimes = get_mtimes(self.paths)
+
+    def fileno(self):
+        # For select(), None when polling
+        return self.fd
+
+    def changed(self):
+        if self.fd is None:
+            # A directory's mtime changes when files are added, removed or
+            # renamed in it (but not when one is rewritten, so watch files
+            # themselves for that)
+            mtimes = get_mtimes(self.paths)
+            changed = mtimes != self.mtimes
+            self.mtimes = mtimes
+            return changed
+
+        changed = False
+
+        while True:
+            try:
+                events = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            if not events:
+                return changed
+
+            changed = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
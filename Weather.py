@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import re
+import sys
+
+
+# Sorts the weather the provider reports into the few kinds there are
+# wallpapers for (see --naming): by its numeric condition code where there is
+# one, and by words in the condition text otherwise. The rules are compiled
+# once, and every distinct condition is only classified once.
+#
+# They can be extended with a JSON file in the config directory, e.g.
+#
+#     {"cloudy": ["fog", "mist", 20], "normal": ["haze"]}
+#
+# strings being the start of words in the text, numbers condition codes.
+# Rules from the file come before the built-in ones.
+
+SUMMARIES = ['thunder', 'snow', 'rain', 'wind', 'cloudy', 'normal']
+
+# Tried in this order, so that "thundershowers" is thunder and "rain and
+# snow" is snow. Each is the start of a word: "breez" is breeze and breezy.
+CONDITION_WORDS = [
+    ('thunder', ['thunder']),
+    ('snow', ['snow', 'sleet', 'flurr', 'blizzard']),
+    ('rain', ['drizzle', 'rain', 'shower', 'hail']),
+    ('wind', ['breez', 'gale', 'wind', 'blust', 'tornado', 'hurricane', 'tropical storm']),
+    ('cloudy', ['cloud', 'overcast']),
+]
+
+# Yahoo! Weather condition codes
+CONDITION_CODES = {
+    0: 'wind',      # tornado
+    1: 'wind',      # tropical storm
+    2: 'wind',      # hurricane
+    3: 'thunder',   # severe thunderstorms
+    4: 'thunder',   # thunderstorms
+    5: 'snow',      # mixed rain and snow
+    6: 'snow',      # mixed rain and sleet
+    7: 'snow',      # mixed snow and sleet
+    8: 'rain',      # freezing drizzle
+    9: 'rain',      # drizzle
+    10: 'rain',     # freezing rain
+    11: 'rain',     # showers
+    12: 'rain',     # showers
+    13: 'snow',     # snow flurries
+    14: 'snow',     # light snow showers
+    15: 'snow',     # blowing snow
+    16: 'snow',     # snow
+    17: 'rain',     # hail
+    18: 'snow',     # sleet
+    19: 'normal',   # dust
+    20: 'normal',   # foggy
+    21: 'normal',   # haze
+    22: 'normal',   # smoky
+    23: 'wind',     # blustery
+    24: 'wind',     # windy
+    25: 'normal',   # cold
+    26: 'cloudy',   # cloudy
+    27: 'cloudy',   # mostly cloudy (night)
+    28: 'cloudy',   # mostly cloudy (day)
+    29: 'cloudy',   # partly cloudy (night)
+    30: 'cloudy',   # partly cloudy (day)
+    31: 'normal',   # clear (night)
+    32: 'normal',   # sunny
+    33: 'normal',   # fair (night)
+    34: 'normal',   # fair (day)
+    35: 'rain',     # mixed rain and hail
+    36: 'normal',   # hot
+    37: 'thunder',  # isolated thunderstorms
+    38: 'thunder',  # scattered thunderstorms
+    39: 'thunder',  # scattered thunderstorms
+    40: 'rain',     # scattered showers
+    41: 'snow',     # heavy snow
+    42: 'snow',     # scattered snow showers
+    43: 'snow',     # heavy snow
+    44: 'cloudy',   # partly cloudy
+    45: 'thunder',  # thundershowers
+    46: 'snow',     # snow showers
+    47: 'thunder',  # isolated thundershowers
+    3200: 'normal', # not available
+}
+
+MAPPING_FILE = 'conditions.json'
+
+# Forget the classified conditions if there are ever this many
+MAX_CLASSIFIED = 1024
+
+# Classifiers, keyed by mapping file
+classifiers = {}
+
+
+def compile_words(words):
+    return [(summary, re.compile(r'\b(?:{})'.format('|'.join(re.escape(i) for i in patterns))))
+            for summary, patterns in words if patterns]
+
+
+class Classifier:
+
+    def __init__(self, rules):
+        # rules: [(words, codes)], tried in order - the user's, then the
+        # built-in ones. words is [(summary, [start of a word, ...])], codes
+        # is {code: summary}.
+
+        self.rules = [(compile_words(words), codes) for words, codes in rules]
+
+        # {(text, code): summary}
+        self.classified = {}
+
+    def classify(self, text, code=None):
+        key = (text, code)
+
+        if key not in self.classified:
+            if len(self.classified) >= MAX_CLASSIFIED:
+                self.classified.clear()
+
+            self.classified[key] = self.match(text, code)
+
+        return self.classified[key]
+
+    def match(self, text, code):
+        try:
+            code = int(code)
+        except (TypeError, ValueError):
+            code = None
+
+        text = (text or '').lower()
+
+        for matchers, codes in self.rules:
+            if code in codes:
+                return codes[code]
+
+            for summary, matcher in matchers:
+                if matcher.search(text):
+                    return summary
+
+        return 'normal'
+
+
+def load_mapping(mapping_file):
+    # ([(summary, words)], {code: summary}) from a mapping file, empty if
+    # there is none
+
+    try:
+        with open(mapping_file, encoding='utf-8') as f:
+            mapping = json.load(f)
+
+    except FileNotFoundError:
+        return [], {}
+
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Could not read {}: {}\n'.format(mapping_file, e))
+        return [], {}
+
+    if not isinstance(mapping, dict):
+        sys.stderr.write('Ignoring {}: expected an object of summaries.\n'.format(mapping_file))
+        return [], {}
+
+    words = []
+    codes = {}
+
+    for summary, rules in mapping.items():
+        if summary not in SUMMARIES:
+            sys.stderr.write('Ignoring unknown weather "{}" in {}.\n'.format(summary, mapping_file))
+            continue
+
+        if not isinstance(rules, list):
+            rules = [rules]
+
+        words.append((summary, [i.lower() for i in rules if isinstance(i, str)]))
+
+        for code in rules:
+            if isinstance(code, int):
+                codes[code] = summary
+
+    return words, codes
+
+
+def make_classifier(mapping_file=None):
+    rules = [(CONDITION_WORDS, CONDITION_CODES)]
+
+    if mapping_file:
+        rules.insert(0, load_mapping(mapping_file))
+
+    return Classifier(rules)
+
+
+def get_classifier(mapping_file=None):
+    if mapping_file not in classifiers:
+        classifiers[mapping_file] = make_classifier(mapping_file)
+
+    return classifiers[mapping_file]
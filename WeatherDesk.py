@@ -19,21 +19,123 @@
 # along with WeatherDesk (in the LICENSE file).
 # If not, see <http://www.gnu.org/licenses/>.
 
+# Only what every run needs is imported up here, the rest (networking,
+# asyncio, image scaling, ...) where it is used, to keep startup fast for
+# --one-time-run and --no-weather. See benchmarks/startup.py.
+
 import argparse
 import datetime
 import json
 import os
-import subprocess
 import sys
+import threading
 import time
-import traceback
-import urllib.error
-import urllib.parse
 
 from itertools import product
-from urllib.request import urlopen
 
+import Daytime
 import Desktop
+import Files
+import Metrics
+import Wallpapers
+import Weather
+
+CACHE_DIR = Desktop.get_cache_dir('weatherdesk')
+
+CONFIG_DIR = Desktop.get_config_dir('weatherdesk')
+
+WEATHER_PROVIDER = 'yahoo'
+
+WEATHER_PROVIDERS = ['yahoo']
+
+# Where --serve-weather and --weather-server meet by default
+WEATHER_SOCKET = '/run/weatherdesk/weather.sock'
+
+# Cities --serve-weather keeps the weather of, the least recently fetched go
+# first: any user may ask for any number of them
+MAX_SERVED_CITIES = 64
+
+# Optional, in INI format: the options (long names, without the dashes) in a
+# [weatherdesk] section, plus the settings below. Re-read while running, see
+# watch_config().
+CONFIG_FILE = os.path.join(CONFIG_DIR, 'weatherdesk.conf')
+CONFIG_SECTION = 'weatherdesk'
+
+# Settings only the config file has: {name: default}
+CONFIG_SETTINGS = {'provider': WEATHER_PROVIDERS[0], 'cache-dir': CACHE_DIR}
+
+# Options that are paths, which can start with ~ in the config file (no
+# shell expands it there)
+CONFIG_PATH_OPTIONS = ['dir', 'metrics', 'export-schedule', 'weather-server', 'serve-weather', 'control-socket']
+
+# Options that only make sense on the command line
+COMMAND_LINE_OPTIONS = ['help', 'naming', 'export-schedule']
+
+# Options that cannot change while running, only on a restart
+RESTART_OPTIONS = {'one_time_run': 'one-time-run', 'async_mode': 'async', 'control_socket': 'control-socket',
+                   'serve_weather': 'serve-weather'}
+
+# How often to look at the config file when inotify is not available, and
+# how long to let an editor finish saving it before reading it
+CONFIG_POLL_INTERVAL = 10
+CONFIG_SETTLE_DELAY = 0.2
+
+# Wall-clock drift (in seconds) from the monotonic clock during a sleep that
+# we take to mean a suspend/resume or a clock change
+CLOCK_JUMP_TOLERANCE = 5
+
+# After this many failed fetches in a row, stop asking the weather provider
+# for this many seconds
+CIRCUIT_BREAKER_FAILURES = 3
+CIRCUIT_BREAKER_COOLDOWN = 300
+
+# First delay (in seconds) before retrying after a network error, doubled
+# for every further error up to --wait
+RETRY_DELAY = 15
+
+# What /proc/net/arp shows for an entry still being resolved
+INCOMPLETE_HARDWARE_ADDRESS = '00:00:00:00:00:00'
+
+weather_circuit = {'failures': 0, 'open_until': 0}
+
+# (path, mtime, desktop, display) of the last wallpaper we set
+last_applied_wallpaper = None
+
+# ipinfo.io's answer, see get_ip_location()
+ip_location = {}
+
+# The weather being fetched in the background, see refresh_weather()
+weather_refresh = {'thread': None, 'failures': 0, 'retry_at': 0}
+
+# Set to wake up the loop early: when a background refresh is done, or on a
+# control request (see wake_up())
+wake_loop = threading.Event()
+
+# The same for the --async loop, which waits on an asyncio.Event instead of
+# tying up an executor thread: {'loop', 'event'} while it runs
+async_wake = {'loop': None, 'event': None}
+
+# What the loop is up to, for the control socket's status
+loop_state = {'last_update': None, 'last_error': None, 'next_update': None}
+
+# Changes asked for over the control socket, applied by the loop before its
+# next update (see apply_control_requests()), and the requests waiting for
+# that update to finish
+control_requests = {}
+control_waiters = []
+control_lock = threading.Lock()
+
+CONTROL_COMMANDS = ['refresh', 'status', 'set-city', 'set-dir', 'reload']
+
+# How long "ctl refresh" waits for the weather before updating without it,
+# within the time it waits for the update (see answer_control_request())
+CONTROL_REFRESH_TIMEOUT = 40
+
+# The --serve-weather server to get the weather and location from, if any
+weather_server = {'socket': None}
+
+# See answer_weather_request()
+weather_server_lock = threading.Lock()
 
 NAMING_RULES = '''
 This is how to name files in the wallpaper directory:\n
@@ -48,10 +150,14 @@ _________________________|________________
  Cloudy:				 | cloudy{0}
  Other:				     | normal{0}
 
+ Conditions are matched by word, so "Light Rain Showers" is rain. Your own
+ rules can go in {1}, e.g.
+ {{"cloudy": ["fog", "mist"], "rain": ["hail"]}}
+
  If using with --time or --time 3, add:
  "day-", "night-" or "evening-" in front of filename.
 
- If using with --time 4, add:
+ If using with --time 4 or --time solar, add:
  "morning-", "day-", "evening-" or "night-"
 
  If using with --time 2, add:
@@ -59,10 +165,22 @@ _________________________|________________
  
  If you use --no-weather, the files have to be named simply after the time of day depending of your time schema.
  E.g.: "day.jpg", "night.jpg"
+
+ Other image formats (.png, .jpeg, ...) work too. If a name exists in several
+ formats, the {0} one is used.
+
+ To take turns between several wallpapers (see --rotate), add more files with
+ anything after a "-", or put them in a directory with the name.
+ E.g.: "night-rain-1{0}", "night-rain-2{0}" or "night-rain/*{0}"
+ The next one is shown each time the weather or time of day changes to it.
 '''
 
 
-def get_args():
+def get_time_level(time_arg):
+    return time_arg if time_arg == 'solar' else int(time_arg)
+
+
+def get_arg_parser():
     arg_parser = argparse.ArgumentParser(
         description='''WeatherDesk - Change the wallpaper based on the weather
         (Uses the Yahoo! Weather API)''',
@@ -75,16 +193,29 @@ def get_args():
 
     arg_parser.add_argument(
         '-f', '--format', metavar='format', type=str,
-        help='Specify image file format. Default: %s' % '.jpg',
+        help='Specify preferred image file format. Default: %s' % '.jpg',
         default='.jpg',
         required=False)
 
     arg_parser.add_argument(
         '-w', '--wait', metavar='seconds', type=int,
-        help='Specify time (in seconds) to wait before updating. Default: 600',
+        help='Specify time (in seconds) to wait before retrying a failed update. Default: 600',
+        default=600,
+        required=False)
+
+    arg_parser.add_argument(
+        '--cache-ttl', metavar='seconds', type=int,
+        help='Specify time (in seconds) for which a fetched weather is reused. Default: 600',
         default=600,
         required=False)
 
+    arg_parser.add_argument(
+        '--max-weather-age', metavar='seconds', type=int,
+        help='Specify time (in seconds) for which the last known weather is still used while a newer one\n'
+             'cannot be fetched. After that, wallpapers go by the time of day only. Default: 10800',
+        default=10800,
+        required=False)
+
     arg_parser.add_argument(
         '-t', '--time', nargs='?',
         help='''Use different backgrounds for different times.\n
@@ -92,9 +223,20 @@ def get_args():
       2 = day/night
       3 = day/evening/night [Default]
       4 = morning/day/evening/night
+      solar = like 4, following the sun: morning and evening
+              are civil twilight (see --location)
     
     See --naming.''',
-        type=int, choices=[2, 3, 4], default=3, required=False)
+        type=get_time_level, choices=[2, 3, 4, 'solar'], const=3, default=3, required=False)
+
+    arg_parser.add_argument(
+        '--thresholds', metavar='HH:MM', type=str, nargs='+',
+        help='''Specify when each time of day starts, in order.\n
+    Defaults:
+      --time 2: 06:00 20:00
+      --time 3: 06:00 17:00 20:00
+      --time 4: 06:00 08:00 17:00 20:00''',
+        required=False)
 
     arg_parser.add_argument(
         '-n', '--naming', action='store_true',
@@ -112,20 +254,235 @@ def get_args():
         help=str('Specify city for weather. If not given, taken from ipinfo.io.'),
         nargs='+', required=False)
 
+    arg_parser.add_argument(
+        '--location', metavar='lat,lon', type=str,
+        help='Specify where you are, for --time solar. If not given, taken from ipinfo.io.',
+        required=False)
+
+    arg_parser.add_argument(
+        '--geolocation-ttl', metavar='seconds', type=int,
+        help='Specify time (in seconds) for which the city and location from ipinfo.io are reused,\n'
+             'unless the network changes. Default: 86400',
+        default=86400,
+        required=False)
+
+    arg_parser.add_argument(
+        '--weather-server', metavar='socket', type=str, nargs='?', const=WEATHER_SOCKET,
+        help='Get the weather and location from a WeatherDesk started with --serve-weather on this machine,\n'
+             'instead of from the internet. Default socket: %s' % WEATHER_SOCKET,
+        required=False)
+
+    arg_parser.add_argument(
+        '--serve-weather', metavar='socket', type=str, nargs='?', const=WEATHER_SOCKET,
+        help='Fetch the weather for the --weather-server sessions on this machine (one fetch per city\n'
+             'for all of them, keeping the last %d cities), instead of setting the wallpaper.\n'
+             'Default socket: %s' % (MAX_SERVED_CITIES, WEATHER_SOCKET),
+        required=False)
+
+    arg_parser.add_argument(
+        '--control-socket', metavar='socket', type=str, nargs='?', const=get_default_control_socket(),
+        help='Take requests from "WeatherDesk.py ctl" while running. Default socket:\n'
+             '$XDG_RUNTIME_DIR/weatherdesk/control.sock',
+        required=False)
+
+    arg_parser.add_argument(
+        '--export-schedule', metavar='directory', type=str, nargs='?', const=CONFIG_DIR,
+        help='With --no-weather, hand the whole day over to the desktop and exit: as a slideshow\n'
+             'on GNOME, Cinnamon and MATE, otherwise as a systemd timer or crontab to install.\n'
+             'Default directory: %s' % CONFIG_DIR,
+        required=False)
+
     arg_parser.add_argument(
         '-o', '--one-time-run', action='store_true',
         help='Run once, then exit.',
         required=False)
 
-    return vars(arg_parser.parse_args())
+    arg_parser.add_argument(
+        '--async', action='store_true', dest='async_mode',
+        help='Run the loop on asyncio, fetching the weather alongside the other work\n'
+             'and running desktop commands with a timeout.',
+        required=False)
+
+    arg_parser.add_argument(
+        '-r', '--rotate', type=str, choices=Wallpapers.ROTATIONS, default='shuffle',
+        help='''How to take turns between several wallpapers for the same weather and time.\n
+    Variations:
+      shuffle = random order, each once per round [Default]
+      order = alphabetical order
+
+    The next one is taken when the weather or time of day changes.
+    See --naming.''',
+        required=False)
+
+    arg_parser.add_argument(
+        '--prescale', action='store_true',
+        help='Scale wallpapers down to the screen size (once, then cached) before setting them.\n'
+             'Needs Pillow.',
+        required=False)
+
+    arg_parser.add_argument(
+        '--prescale-cache-size', metavar='MB', type=int,
+        help='Specify the size of the cache of scaled wallpapers. Default: 256',
+        default=256,
+        required=False)
+
+    arg_parser.add_argument(
+        '--metrics', metavar='file', type=str,
+        help='Write update counts and timings to file after every update:\n'
+             'as JSON if it ends with .json, in the Prometheus text format otherwise.',
+        required=False)
+
+    arg_parser.add_argument(
+        '--force', action='store_true',
+        help='Set the wallpaper even if it is already the current one.',
+        required=False)
+
+    return arg_parser
+
+
+def read_config(config_file):
+    # {name: value} from the config file, {} if there is none. Raises
+    # ValueError if it cannot be read.
+
+    try:
+        with open(config_file, encoding='utf-8') as f:
+            text = f.read()
+
+    except FileNotFoundError:
+        return {}
+
+    except (OSError, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+
+    import configparser
+
+    config = configparser.ConfigParser(interpolation=None)
+
+    try:
+        config.read_string(text, config_file)
+    except configparser.Error as e:
+        raise ValueError(str(e))
+
+    if not config.has_section(CONFIG_SECTION):
+        return {}
+
+    return {name.replace('_', '-'): value for name, value in config[CONFIG_SECTION].items()}
+
+
+def get_config_defaults(arg_parser, config):
+    # The options in config, as defaults for arg_parser (so the command line
+    # still wins), converted the way argparse would. Raises ValueError for an
+    # unknown option or a wrong value.
+
+    if not config:
+        return {}
+
+    import configparser
+
+    actions = {option[2:]: action for action in arg_parser._actions for option in action.option_strings
+               if option.startswith('--') and option[2:] not in COMMAND_LINE_OPTIONS}
+
+    defaults = {}
+
+    for name, value in config.items():
+        if name in CONFIG_SETTINGS:
+            continue
+
+        if name not in actions:
+            raise ValueError('Unknown option {}'.format(name))
+
+        action = actions[name]
+
+        if action.nargs == 0:  # A flag
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError('{} must be yes or no, not {}'.format(name, value))
+
+            defaults[action.dest] = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+            continue
+
+        if name in CONFIG_PATH_OPTIONS:
+            value = os.path.expanduser(value)
+
+        values = value.split() if action.nargs in ['+', '*'] else [value]
+
+        try:
+            values = [action.type(i) for i in values] if action.type else values
+        except (TypeError, ValueError):
+            raise ValueError('Invalid {}: {}'.format(name, value))
+
+        if action.choices and any(i not in action.choices for i in values):
+            raise ValueError('{} must be one of {}, not {}'.format(
+                name, ', '.join(str(i) for i in action.choices), value))
+
+        defaults[action.dest] = values if action.nargs in ['+', '*'] else values[0]
+
+    return defaults
+
+
+def get_config_settings(config):
+    # CONFIG_SETTINGS from config, as args entries
+
+    provider = config.get('provider', CONFIG_SETTINGS['provider'])
+
+    if provider not in WEATHER_PROVIDERS:
+        raise ValueError('provider must be one of {}, not {}'.format(', '.join(WEATHER_PROVIDERS), provider))
+
+    return {'provider': provider,
+            'cache_dir': os.path.abspath(os.path.expanduser(config.get('cache-dir', CONFIG_SETTINGS['cache-dir'])))}
+
+
+def get_args(config=None):
+    # The command line, on top of the config file. Raises ValueError if the
+    # config file has a wrong value.
+
+    arg_parser = get_arg_parser()
+
+    config = config or {}
+
+    arg_parser.set_defaults(**get_config_defaults(arg_parser, config))
+
+    args = vars(arg_parser.parse_args())
+    args.update(get_config_settings(config))
+
+    return args
+
+
+def apply_settings(args):
+    global CACHE_DIR, WEATHER_PROVIDER
+
+    CACHE_DIR = args['cache_dir']
+    WEATHER_PROVIDER = args['provider']
 
 
 def validate_args(args):
     parsed_args = dict(args).copy()
 
+    weather_server['socket'] = args['weather_server']
+
+    # Whether the city was given or looked up, see apply_control_requests()
+    parsed_args['city_arg'] = args['city']
+
+    # What the config file is compared with when it changes
+    parsed_args['args'] = args
+
+    # Options changed over the control socket, which win over the config
+    # file from then on (see reload_config())
+    parsed_args['overrides'] = {}
+
+    if args['export_schedule']:
+        if not args['no_weather']:
+            sys.stderr.write('--export-schedule needs --no-weather, the weather cannot be known in advance.\n')
+            sys.exit(1)
+
+        if args['time'] == 'solar':
+            sys.stderr.write('--export-schedule needs fixed times of day, not --time solar.\n')
+            sys.exit(1)
+
     if not parsed_args['no_weather']:
+        import urllib.error
+
         try:
-            parsed_args['city'] = get_city(args['city'])
+            parsed_args['city'] = get_city(args['city'], args['geolocation_ttl'])
         except (urllib.error.URLError, ValueError):
             sys.stderr.write(
                 'Finding city from IP failed! Specify city manually with --city.')
@@ -134,13 +491,42 @@ def validate_args(args):
     try:
         parsed_args['walls_dir'] = get_config_dir(args['dir'])
     except ValueError as e:
-        sys.stderr.write(e)
+        sys.stderr.write(str(e) + '\n')
         sys.exit(1)
 
     parsed_args['file_format'] = get_file_format(args['format'])
 
     parsed_args['wait_time'] = args['wait']  # ten minutes
 
+    parsed_args['cache_ttl'] = args['cache_ttl']
+
+    # In bytes, 0 when not scaling at all
+    parsed_args['prescale_cache_size'] = args['prescale_cache_size'] * 1024 * 1024 if args['prescale'] else 0
+
+    if args['time'] == 'solar':
+        if args['thresholds']:
+            sys.stderr.write('--thresholds cannot be used with --time solar.\n')
+            sys.exit(1)
+
+        import urllib.error
+
+        try:
+            parsed_args['schedule'] = Daytime.SolarSchedule(*get_coordinates(args['location'],
+                                                                             args['geolocation_ttl']))
+        except urllib.error.URLError:
+            sys.stderr.write('Finding location from IP failed! Specify it manually with --location.\n')
+            sys.exit(1)
+        except ValueError as e:
+            sys.stderr.write('Invalid --location: {}\n'.format(e))
+            sys.exit(1)
+
+    else:
+        try:
+            parsed_args['schedule'] = Daytime.get_schedule(args['time'], args['thresholds'])
+        except ValueError as e:
+            sys.stderr.write('Invalid --thresholds: {}\n'.format(e))
+            sys.exit(1)
+
     missing_files = get_missing_files(
         time_level=parsed_args['time'],
         no_weather=parsed_args['no_weather'],
@@ -156,57 +542,11 @@ def validate_args(args):
     return parsed_args
 
 
-def get_time_of_day(level=3, hour=None):
-    """
-    For detail level 2:
-    06 to 20: day
-    20 to 06: night
-
-    For detail level 3:
-    06 to 17: day
-    17 to 20: evening
-    20 to 06: night
-
-    For detail level 4:
-    06 to 08: morning
-    08 to 17: day
-    17 to 20: evening
-    20 to 06: night
-    """
-    if hour is None:
-        current_hour = datetime.datetime.now().hour
-    else:
-        current_hour = hour
-
-    if level == 2:
-        labels = ['day', 'night']
-        thres = [5, 19]
-    elif level == 3:
-        labels = ['day', 'evening', 'night']
-        thres = [5, 16, 19]
-    elif level == 4:
-        labels = ['morning', 'day', 'evening', 'night']
-        thres = [5, 7, 16, 19]
-    else:
-        raise ValueError('Invalid time level.')
-
-    thres.append(current_hour)
-    thres.sort()
-    day_index = thres.index(current_hour)
-    return labels[day_index - 1]
-
-
-def get_weather_summary(weather_name):
-    summaries = {'rain': ['drizzle', 'rain', 'shower'],
-                 'wind': ['breez', 'gale', 'wind'],  # breez matches both breeze and breezy
-                 'thunder': ['thunder'],
-                 'snow': ['snow'],
-                 'cloudy': ['cloud']}
+def get_weather_summary(weather_name, weather_code=None):
+    # See Weather.py, and conditions.json in the config directory for your own rules
+    mapping_file = os.path.join(CONFIG_DIR, Weather.MAPPING_FILE)
 
-    for summary, options in summaries.items():
-        if weather_name in options:
-            return summary
-    return 'normal'
+    return Weather.get_classifier(mapping_file).classify(weather_name, weather_code)
 
 
 def get_config_dir(config_dir_arg):
@@ -234,7 +574,7 @@ def get_file_format(file_format_arg):
     return file_format_arg
 
 
-def get_file_name(weather, daytime, walls_dir, file_format):
+def get_wallpaper_name(weather, daytime):
     if weather and daytime:
         name = '{}-{}'.format(daytime, weather)
     elif weather:
@@ -244,7 +584,40 @@ def get_file_name(weather, daytime, walls_dir, file_format):
     else:
         raise ValueError('Either a correct weather or a correct time is required.')
 
-    return os.path.join(walls_dir, name + file_format)
+    return name
+
+
+def get_file_name(weather, daytime, walls_dir, file_format):
+    return os.path.join(walls_dir, get_wallpaper_name(weather, daytime) + file_format)
+
+
+def find_file_name(weather, daytime, walls_dir, file_format, rotation='shuffle'):
+    # Like get_file_name(), but for the file actually in walls_dir, whatever
+    # its format, and taking turns if there are several for this weather and
+    # time: the next one each time the weather or the time of day changes to
+    # it, and the same one for every update in between
+
+    name = get_wallpaper_name(weather, daytime)
+
+    rotation_cache = load_cache('rotation')
+    rotation_state = rotation_cache.setdefault(walls_dir, {})
+
+    # The name last shown for each directory (which are absolute paths, so
+    # this cannot clash with one)
+    last_names = rotation_cache.setdefault('last_names', {})
+    changed = last_names.get(walls_dir) != name
+
+    file_name = Wallpapers.get_index(walls_dir, file_format).choose(name, rotation, rotation_state, changed)
+
+    if file_name is not None and (changed or name in rotation_state):
+        # Remember where the rotation is at across restarts
+        last_names[walls_dir] = name
+        save_cache('rotation', rotation_cache)
+
+    if file_name is None:
+        raise ValueError('Wallpaper {} not found.'.format(get_file_name(weather, daytime, walls_dir, file_format)))
+
+    return file_name
 
 
 def get_missing_files(time_level, no_weather, file_format, walls_dir):
@@ -255,142 +628,1426 @@ def get_missing_files(time_level, no_weather, file_format, walls_dir):
     else:
         weathers = ['rain', 'snow', 'normal', 'cloudy', 'wind', 'thunder']
 
-    if time_level == 2:
-        daytimes = ['day', 'night']
-    elif time_level == 3:  # level 2
-        daytimes = ['day', 'evening', 'night']
-    elif time_level == 4:
-        daytimes = ['morning', 'day', 'evening', 'night']
-    else:
-        daytimes = [None]
+    daytimes = Daytime.LABELS[time_level]
 
-    required_files = (get_file_name(weather, daytime, walls_dir, file_format) for weather, daytime in
-                      product(weathers, daytimes))
+    wallpaper_index = Wallpapers.get_index(walls_dir, file_format)
 
-    for file in required_files:
-        if not os.path.isfile(file):
-            missing_files.append(file)
+    for weather, daytime in product(weathers, daytimes):
+        if wallpaper_index.get(get_wallpaper_name(weather, daytime)) is None:
+            missing_files.append(get_file_name(weather, daytime, walls_dir, file_format))
 
     return missing_files
 
 
-def get_city(city_arg):
+def get_network_identity():
+    # Something that changes when we move to another network: the default
+    # route's interface and gateway, and the gateway's hardware address
+    # (many networks use the same gateway address, see same_network()). None
+    # if not known.
+
+    try:
+        with open('/proc/net/route') as f:
+            routes = [line.split() for line in f.readlines()[1:]]
+
+    except OSError:  # Not Linux
+        return None
+
+    # Destination 0.0.0.0, the one with the lowest metric
+    default_routes = sorted((int(i[6]), i[0], i[2]) for i in routes if len(i) > 6 and i[1] == '00000000')
+
+    if not default_routes:
+        return []
+
+    metric, interface, gateway = default_routes[0]
+
+    # Written as a little-endian hex number
+    gateway = '.'.join(str(int(gateway[i:i + 2], 16)) for i in [6, 4, 2, 0])
+
+    hardware_address = None
+
+    try:
+        with open('/proc/net/arp') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+
+                # Incomplete while the entry is being refreshed
+                if (len(fields) > 5 and fields[0] == gateway and fields[5] == interface and
+                        fields[2] != '0x0' and fields[3] != INCOMPLETE_HARDWARE_ADDRESS):
+                    hardware_address = fields[3]
+
+    except OSError:
+        pass
+
+    return [interface, gateway, hardware_address]
+
+
+def same_network(network, other_network):
+    # Whether two get_network_identity()s are the same network. The
+    # gateway's hardware address is not always known (it comes and goes
+    # with the ARP cache), and only counts if both have it.
+
+    if not network or not other_network:
+        return network == other_network
+
+    if network[:2] != other_network[:2]:
+        return False
+
+    return network[2] is None or other_network[2] is None or network[2] == other_network[2]
+
+
+def get_ip_location(geolocation_ttl=86400):
+    # Where ipinfo.io thinks we are: {'city': ..., 'loc': 'latitude,longitude', ...}.
+    # Looked up once, even if both the city and the coordinates are needed,
+    # and kept in the cache for geolocation_ttl seconds - unless we have moved
+    # to another network since.
+
+    if 'location' not in ip_location:
+        cached = load_cache('location')
+        network = get_network_identity()
+
+        if (cached and time.time() - cached['fetched'] < geolocation_ttl and
+                same_network(cached.get('network'), network)):
+            ip_location['location'] = cached['location']
+
+        else:
+            city_json_url = 'http://ipinfo.io/json'
+
+            import urllib.error
+
+            try:
+                with Metrics.Timer('geolocation'):
+                    if weather_server['socket']:
+                        ip_location['location'] = ask_weather_server({'get': 'location'})['location']
+                    else:
+                        import Http
+
+                        status, headers, ip_location['location'] = Http.get_json(city_json_url)
+
+            except urllib.error.URLError:
+                if not cached:
+                    raise
+
+                # Better where we were than nowhere
+                ip_location['location'] = cached['location']
+
+            else:
+                save_cache('location', {'location': ip_location['location'], 'fetched': time.time(),
+                                        'network': network})
+
+    return ip_location['location']
+
+
+def get_city(city_arg, geolocation_ttl=86400):
     if city_arg:
         city = ' '.join(city_arg).replace(' ', '%20')
     else:
-        city_json_url = 'http://ipinfo.io/json'
+        city = get_ip_location(geolocation_ttl)['city'].replace(' ', '%20')
+    return city
 
-        city_json = urlopen(city_json_url).read().decode('utf-8')
 
-        city = json.loads(city_json)
-        city = city['city'].replace(' ', '%20')
-    return city
+def get_coordinates(location_arg, geolocation_ttl=86400):
+    # (latitude, longitude), for --time solar
 
+    if location_arg:
+        return Daytime.parse_location(location_arg)
+
+    return Daytime.parse_location(get_ip_location(geolocation_ttl).get('loc'))
 
-def get_current_weather(city):
-    weather_json_url = r'https://query.yahooapis.com/v1/public/yql?q=select%20*%20from%20weather.forecast%20where%20woeid%20in%20(select%20woeid%20from%20geo.places(1)%20where%20text%3D%22' + urllib.parse.quote(
-        city) + '%22)&format=json&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys'
 
-    weather_json = json.loads(urlopen(weather_json_url).read().decode('utf-8'))['query']['results']['channel']
+def load_cache(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name + '.json'), encoding='utf-8') as f:
+            return json.load(f)
 
-    weather = str(weather_json['item']['condition']['text']).lower()
+    except (OSError, ValueError):
+        # Missing or corrupt cache, start afresh
+        return {}
 
-    city_with_area = str(weather_json['location']['city']) + str(weather_json['location']['region'])
 
-    return weather, city_with_area
+def save_cache(name, data):
+    # Write to a temporary file and rename it over the old one, so that
+    # other instances (or a crash halfway through) never see a partial file
 
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    Files.replace_file(os.path.join(CACHE_DIR, name + '.json'), lambda f: json.dump(data, f))
+
+
+def check_weather_circuit():
+    import urllib.error
+
+    if time.time() < weather_circuit['open_until']:
+        raise urllib.error.URLError('Weather provider keeps failing, not retrying before {}'.format(
+            datetime.datetime.fromtimestamp(weather_circuit['open_until']).strftime('%H:%M:%S')))
+
+
+def record_weather_result(success):
+    if success:
+        weather_circuit['failures'] = 0
+        weather_circuit['open_until'] = 0
 
-def set_conditional_wallpaper(city, time_level, no_weather, walls_dir, file_format):
-    if not no_weather:
-        weather, actual_city = get_current_weather(city)
-        weather_code = get_weather_summary(weather)
-        print('The retrieved weather for {} is {}'.format(actual_city, weather))
     else:
-        weather_code = None
+        weather_circuit['failures'] += 1
 
-    time_of_day = get_time_of_day(time_level)
-    print('The current time of the day is {}'.format(time_of_day))
+        if weather_circuit['failures'] >= CIRCUIT_BREAKER_FAILURES:
+            # After the cooldown a single attempt is let through, and
+            # another failure opens the circuit right away again
+            weather_circuit['open_until'] = time.time() + CIRCUIT_BREAKER_COOLDOWN
 
-    file_name = get_file_name(weather_code, time_of_day, walls_dir, file_format)
-    print('Changing wallpaper to {}'.format(file_name))
 
-    desktop_env = Desktop.get_desktop_environment()
+def get_current_weather(city, cache_ttl=600):
+    cache = load_cache('weather')
+    cache_key = '{}:{}'.format(WEATHER_PROVIDER, city)
+    cached = cache.get(cache_key)
 
-    Desktop.set_wallpaper(file_name, desktop_env)
+    now = time.time()
 
+    if cached and now < get_cached_expiry(cached, cache_ttl):
+        Metrics.increment('weather_cache_total', result='hit')
+        return cached['weather'], cached['city'], cached.get('code')
 
-def restart_program():
-    # Restarts the current program, with file objects and descriptors cleanup
+    if weather_server['socket']:
+        answer = ask_weather_server({'get': 'weather', 'city': city})
 
-    new_weatherdesk_cmd = ''
+        Metrics.increment('weather_cache_total', result='shared')
 
-    for i in sys.argv:
-        new_weatherdesk_cmd = ' ' + i
+        # As old as the server's copy, not as old as this request, and
+        # expiring with it: asking again before then gets the same copy back
+        cache[cache_key] = {key: answer[key] for key in ['weather', 'city', 'code', 'fetched', 'expires']}
+        save_cache('weather', cache)
 
-    subprocess.Popen([new_weatherdesk_cmd], shell=True)
+        return answer['weather'], answer['city'], answer['code']
 
-    sys.exit(0)
+    import urllib.error
+    import urllib.parse
 
+    import Http
 
-if __name__ == '__main__':
+    weather_json_url = r'https://query.yahooapis.com/v1/public/yql?q=select%20*%20from%20weather.forecast%20where%20woeid%20in%20(select%20woeid%20from%20geo.places(1)%20where%20text%3D%22' + urllib.parse.quote(
+        city) + '%22)&format=json&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys'
 
-    args = get_args()
-    parsed_args = validate_args(args)
+    weather_headers = {}
 
-    if parsed_args['naming']:
-        print(NAMING_RULES.format(parsed_args['file_format']))
-        sys.exit(0)
+    if cached:
+        # Let the server tell us that nothing changed instead of resending it all
+        if cached.get('etag'):
+            weather_headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            weather_headers['If-Modified-Since'] = cached['last_modified']
 
-    if parsed_args['one_time_run']:
-        set_conditional_wallpaper(parsed_args['city'],
-                                  parsed_args['time'],
-                                  parsed_args['no_weather'],
-                                  parsed_args['walls_dir'],
-                                  parsed_args['file_format'])
-        sys.exit(0)
+    check_weather_circuit()
 
-    trace_main_loop = None
+    try:
+        with Metrics.Timer('weather'):
+            status, headers, weather_json = Http.get_json(weather_json_url, weather_headers)
 
-    while True:
-        try:
-            set_conditional_wallpaper(parsed_args['city'],
-                                      parsed_args['time'],
-                                      parsed_args['no_weather'],
-                                      parsed_args['walls_dir'],
-                                      parsed_args['file_format'])
+    except urllib.error.URLError:
+        record_weather_result(False)
+        raise
 
-        except urllib.error.URLError:
-            # Don't shut off on temporary network problems
-            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+    record_weather_result(True)
 
-            if sys.platform.startswith('linux'):
-                # HACK: glibc on Linux only loads /etc/resolv.conf once
-                # This breaks our network communications after suspend/resume
-                # So we force it to reload using the res_init() function
+    if status == 304 and cached:
+        Metrics.increment('weather_cache_total', result='revalidated')
+        cached['fetched'] = now
+        cached.pop('expires', None)
 
-                # But sometimes res_init() mysteriously crashes the program
-                # and it's too low-level for any try-except to catch.
+    else:
+        Metrics.increment('weather_cache_total', result='miss')
 
-                # So we restart the whole thing!
+        weather_json = weather_json['query']['results']['channel']
 
-                restart_program()
+        cached = {
+            'weather': str(weather_json['item']['condition']['text']).lower(),
+            'code': weather_json['item']['condition'].get('code'),
+            'city': str(weather_json['location']['city']) + str(weather_json['location']['region']),
+            'fetched': now,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
 
-        except ValueError:
-            # Sometimes JSON returns a null value for no reason
+    cache[cache_key] = cached
+    save_cache('weather', cache)
 
-            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+    return cached['weather'], cached['city'], cached.get('code')
 
-        except:
-            # All other errors (except KeyboardInterrupt ^C)
-            # We'll still have a full stack trace
 
-            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+def refresh_weather(city, cache_ttl=600, wait_time=600):
+    # Fetch the weather in a thread of its own, unless that is already going
+    # on or it failed too recently (backing off as the main loop does).
+    # wake_loop is set when it is done, unless it got nothing newer.
+
+    thread = weather_refresh['thread']
+
+    if thread is not None and thread.is_alive():
+        return
+
+    if time.time() < weather_refresh['retry_at']:
+        return
+
+    def get_fetched():
+        cached = load_cache('weather').get('{}:{}'.format(WEATHER_PROVIDER, city))
+        return cached['fetched'] if cached else None
+
+    def refresh():
+        import traceback
+        import urllib.error
+
+        fetched = get_fetched()
+
+        try:
+            get_current_weather(city, cache_ttl)
+
+        except Exception:
+            print('[Weather refresh] \n' + traceback.format_exc())
+            Metrics.increment('weather_refresh_total', result='error')
+
+            weather_refresh['failures'] += 1
+            weather_refresh['retry_at'] = time.time() + get_retry_delay(weather_refresh['failures'], wait_time)
+
+            if isinstance(sys.exc_info()[1], urllib.error.URLError):
+                import Http
+
+                Http.close_connections()
+                refresh_resolver()
 
         else:
-            trace_main_loop = '[Main loop] No error.'
+            Metrics.increment('weather_refresh_total', result='ok')
+
+            weather_refresh['failures'] = 0
+            weather_refresh['retry_at'] = 0
+
+            if get_fetched() == fetched:
+                # Nothing newer (another session's server had no newer copy
+                # either), nothing for the loop to do
+                return
+
+        wake_up()
+
+    weather_refresh['thread'] = threading.Thread(target=refresh, name='weather-refresh', daemon=True)
+    weather_refresh['thread'].start()
+
+
+def get_known_weather(city, cache_ttl=600, max_weather_age=10800, wait_time=600):
+    # The last weather we know of, without waiting for the network. Once it
+    # is older than cache_ttl it is refreshed in the background, and once it
+    # is older than max_weather_age it is not used at all: (None, None, None).
+
+    cached = load_cache('weather').get('{}:{}'.format(WEATHER_PROVIDER, city))
+
+    now = time.time()
+
+    age = now - cached['fetched'] if cached else None
+    expired = cached is None or now >= get_cached_expiry(cached, cache_ttl)
+
+    if expired:
+        refresh_weather(city, cache_ttl, wait_time)
+
+    if age is None or age >= max_weather_age:
+        return None, None, None
+
+    Metrics.increment('weather_cache_total', result='stale' if expired else 'hit')
+
+    return cached['weather'], cached['city'], cached.get('code')
+
+
+def ask_weather_server(message):
+    # Ask the --serve-weather server in charge of fetching for everyone.
+    # Fails with URLError, just like fetching it ourselves would.
+
+    import Sockets
+
+    try:
+        answer = Sockets.request(weather_server['socket'], message)
+
+        if 'error' in answer:
+            raise ValueError(answer['error'])
+
+        return answer
+
+    except (OSError, ValueError, KeyError) as e:
+        import urllib.error
+
+        raise urllib.error.URLError('Weather server at {}: {}'.format(weather_server['socket'], e))
+
+
+def answer_weather_request(message, cache_ttl=600, geolocation_ttl=86400):
+    # For --serve-weather. One request at a time: the HTTP client keeps one
+    # connection per host and the caches are read and written whole - and
+    # that way sessions asking for the same city at once wait for one fetch
+    # instead of each making their own.
+
+    with weather_server_lock:
+        if message.get('get') == 'weather':
+            city = str(message['city'])
+
+            weather, actual_city, condition_code = get_current_weather(city, cache_ttl)
+
+            cache = load_cache('weather')
+            cached = cache['{}:{}'.format(WEATHER_PROVIDER, city)]
+
+            if len(cache) > MAX_SERVED_CITIES:
+                for key in sorted(cache, key=lambda key: cache[key]['fetched'])[:len(cache) - MAX_SERVED_CITIES]:
+                    del cache[key]
+
+                save_cache('weather', cache)
+
+            return {'weather': weather, 'city': actual_city, 'code': condition_code, 'fetched': cached['fetched'],
+                    'expires': get_cached_expiry(cached, cache_ttl)}
+
+        elif message.get('get') == 'location':
+            # From the cache again, so that it expires and follows network changes
+            ip_location.clear()
+
+            return {'location': get_ip_location(geolocation_ttl)}
+
+    raise ValueError('Unknown request {}'.format(message.get('get')))
+
+
+def serve_weather(args):
+    import Sockets
+
+    print('Serving the weather on {}'.format(args['serve_weather']))
+
+    # Stopped as a service, clean up the socket all the same
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        # Every user's sessions may ask
+        Sockets.serve(args['serve_weather'],
+                      lambda message: answer_weather_request(message, args['cache_ttl'], args['geolocation_ttl']),
+                      mode=0o666)
+
+    except OSError as e:
+        sys.stderr.write('Could not serve the weather on {}: {}\n'.format(args['serve_weather'], e))
+        sys.exit(1)
+
+    except KeyboardInterrupt:
+        pass
+
+
+def get_cached_expiry(cached, cache_ttl=600):
+    # When a cached weather needs fetching again: after cache_ttl, or when
+    # the --serve-weather copy it came from does (see get_current_weather())
+
+    return cached.get('expires', cached['fetched'] + cache_ttl)
+
+
+def get_weather_expiry(city, cache_ttl=600):
+    cached = load_cache('weather').get('{}:{}'.format(WEATHER_PROVIDER, city))
+
+    if cached:
+        return get_cached_expiry(cached, cache_ttl)
+
+    return None
+
+
+def get_next_update_time(city, schedule, no_weather, cache_ttl=600, wait_time=600):
+    # Nothing can change the wallpaper before the time of day changes or the
+    # cached weather expires, so there is no point in waking up earlier
+
+    now = time.time()
+
+    next_update = schedule.get_next_boundary().timestamp()
+
+    if not no_weather:
+        weather_expiry = get_weather_expiry(city, cache_ttl)
+
+        if weather_expiry is None or weather_expiry <= now:
+            # Fetching failed, retry later - or being fetched in the
+            # background, and wake_loop will wake us up
+            if weather_refresh['retry_at'] > now:
+                weather_expiry = weather_refresh['retry_at']
+            else:
+                weather_expiry = now + wait_time
+
+        next_update = min(next_update, weather_expiry)
+
+    return next_update
+
+
+def schedule_next_update(parsed_args, network_failures=0):
+    next_update = get_next_update_time(parsed_args['city'],
+                                       parsed_args['schedule'],
+                                       parsed_args['no_weather'],
+                                       parsed_args['cache_ttl'],
+                                       parsed_args['wait_time'])
+
+    if network_failures:
+        next_update = min(next_update,
+                          time.time() + get_retry_delay(network_failures, parsed_args['wait_time']))
+
+    print('Next update at {}'.format(datetime.datetime.fromtimestamp(next_update).strftime('%H:%M:%S')))
+
+    loop_state['next_update'] = next_update
+
+    return next_update
+
+
+def record_update(error=None):
+    # error is the exception class the update failed with, if it did
+
+    Metrics.record_update(error)
+
+    loop_state['last_update'] = time.time()
+    loop_state['last_error'] = error.__name__ if error else None
+
+
+def get_default_control_socket():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'weatherdesk', 'control.sock')
+
+    return os.path.join(CACHE_DIR, 'control.sock')
+
+
+def get_status(parsed_args):
+    weather = None
+
+    if not parsed_args['no_weather']:
+        weather = load_cache('weather').get('{}:{}'.format(WEATHER_PROVIDER, parsed_args['city']))
+
+    return {
+        'city': parsed_args['city'].replace('%20', ' ') if parsed_args['city'] else None,
+        'walls_dir': parsed_args['walls_dir'],
+        'time': parsed_args['time'],
+        'time_of_day': parsed_args['schedule'].get_period(),
+        'weather': weather,
+        'wallpaper': last_applied_wallpaper,
+        'last_update': loop_state['last_update'],
+        'last_error': loop_state['last_error'],
+        'next_update': loop_state['next_update'],
+        'timings': Metrics.get_last_durations(),
+        'backend_timings': Desktop.backend_timings,
+    }
+
+
+def answer_control_request(message, parsed_args, timeout=50):
+    # For the control socket (see --control-socket). Checks what it can
+    # right away, leaves the rest to the loop, and answers with the status
+    # once the update that applied it is done (or after timeout seconds).
+
+    command = message.get('command')
+    args = message.get('args') or []
+
+    if command == 'status':
+        return get_status(parsed_args)
+
+    elif command == 'refresh':
+        request = {'refresh': True}
+
+    elif command == 'set-city':
+        if parsed_args['no_weather']:
+            raise ValueError('Not using the weather (--no-weather)')
+
+        if not args:
+            raise ValueError('set-city needs a city')
+
+        request = {'city': get_city(args), 'city_words': args}
+
+    elif command == 'set-dir':
+        if len(args) != 1:
+            raise ValueError('set-dir needs a directory')
+
+        walls_dir = get_config_dir(args[0])
+
+        missing_files = get_missing_files(parsed_args['time'], parsed_args['no_weather'], parsed_args['file_format'],
+                                          walls_dir)
+
+        if missing_files:
+            raise ValueError('Missing files: ' + ', '.join(missing_files))
+
+        request = {'walls_dir': walls_dir}
+
+    elif command == 'reload':
+        request = {'reload': True}
+
+    else:
+        raise ValueError('Unknown command {}, expected one of {}'.format(command, ', '.join(CONTROL_COMMANDS)))
+
+    applied = threading.Event()
+
+    with control_lock:
+        control_requests.update(request)
+        control_waiters.append(applied)
+
+    wake_up()
+
+    applied.wait(timeout)
+
+    return get_status(parsed_args)
+
+
+def apply_control_requests(parsed_args):
+    # Called by the loop before each update. Returns whether the next update
+    # has to set the wallpaper even if it has not changed.
+
+    with control_lock:
+        requests = dict(control_requests)
+        control_requests.clear()
+
+    # Only force an update for the config file if it really changed
+    config_changed = False
+
+    if requests.pop('config', False) or requests.get('reload'):
+        config_changed = reload_config(parsed_args)
+
+    if requests.get('reload'):
+        # Read the wallpaper directory and conditions.json again
+        for index in Wallpapers.indexes.values():
+            index.close()
+
+        Wallpapers.indexes.clear()
+        Weather.classifiers.clear()
+
+        if not parsed_args['no_weather'] and not parsed_args['city_arg']:
+            import urllib.error
+
+            ip_location.clear()
+
+            try:
+                parsed_args['city'] = get_city(None, parsed_args['geolocation_ttl'])
+            except (urllib.error.URLError, KeyError, ValueError):
+                print('Finding city from IP failed, keeping {}'.format(parsed_args['city']))
+
+    # After reloading, which must not undo them
+    if 'city' in requests:
+        parsed_args['city'] = requests['city']
+        parsed_args['city_arg'] = requests['city_words']
+        set_override(parsed_args, 'city', requests['city_words'])
+
+    if 'walls_dir' in requests:
+        parsed_args['walls_dir'] = requests['walls_dir']
+        set_override(parsed_args, 'dir', requests['walls_dir'])
+
+    if requests.get('refresh') and not parsed_args['no_weather']:
+        weather_refresh['retry_at'] = 0
+        refresh_weather(parsed_args['city'], 0, parsed_args['wait_time'])
+
+        # So that this update (and the answer to the request) has the new
+        # weather, or a failure to show for it
+        weather_refresh['thread'].join(CONTROL_REFRESH_TIMEOUT)
+
+    return bool(requests) or config_changed
+
+
+def follow_location(parsed_args):
+    # Look up where we are again when the location from ipinfo.io expires
+    # (--geolocation-ttl) or we move to another network, and follow it with
+    # the city and the solar schedule. Nothing to do for a given --city and
+    # --location. Returns whether anything changed.
+
+    import urllib.error
+
+    follow_city = not parsed_args['no_weather'] and not parsed_args['city_arg']
+    follow_coordinates = parsed_args['time'] == 'solar' and not parsed_args['location']
+
+    if not follow_city and not follow_coordinates:
+        return False
+
+    # Checked against the cache and the network (see get_ip_location()),
+    # which takes a request only when either has changed
+    ip_location.clear()
+
+    try:
+        city = get_city(None, parsed_args['geolocation_ttl']) if follow_city else parsed_args['city']
+        coordinates = (get_coordinates(None, parsed_args['geolocation_ttl']) if follow_coordinates else None)
+
+    except (urllib.error.URLError, KeyError, ValueError):
+        print('Finding location from IP failed, staying in {}'.format(parsed_args['city'] or 'the same place'))
+        return False
+
+    changed = False
+
+    if city != parsed_args['city']:
+        print('Moved to {}'.format(city.replace('%20', ' ')))
+        parsed_args['city'] = city
+        changed = True
+
+    schedule = parsed_args['schedule']
+
+    if coordinates and coordinates != (schedule.latitude, schedule.longitude):
+        parsed_args['schedule'] = Daytime.SolarSchedule(*coordinates)
+        changed = True
+
+    return changed
+
+
+def prepare_update(parsed_args):
+    # Before each update in the loop. Returns whether it has to set the
+    # wallpaper even if it has not changed.
+
+    force = apply_control_requests(parsed_args)
+
+    return follow_location(parsed_args) or force
+
+
+def set_override(parsed_args, key, value):
+    # Keep an option set over the control socket when the config file
+    # changes, and do not take it for a change of the file either
+
+    parsed_args['overrides'][key] = value
+    parsed_args['args'][key] = value
+
+
+def get_config_updates(args, changed):
+    # The parsed_args entries to replace for the changed options: the options
+    # themselves, and whatever was made from them. Raises ValueError (or
+    # URLError) if they do not work.
+
+    updates = {key: args[key] for key in changed}
+
+    if changed & {'dir', 'format', 'time', 'no_weather'}:
+        updates['walls_dir'] = get_config_dir(args['dir'])
+        updates['file_format'] = get_file_format(args['format'])
+
+        missing_files = get_missing_files(args['time'], args['no_weather'], updates['file_format'],
+                                          updates['walls_dir'])
+
+        if missing_files:
+            raise ValueError('Missing files: ' + ', '.join(missing_files))
+
+    if changed & {'time', 'thresholds', 'location'} or (args['time'] == 'solar' and 'geolocation_ttl' in changed):
+        if args['time'] != 'solar':
+            updates['schedule'] = Daytime.get_schedule(args['time'], args['thresholds'])
+
+        elif args['thresholds']:
+            raise ValueError('thresholds cannot be used with time = solar')
+
+        else:
+            updates['schedule'] = Daytime.SolarSchedule(*get_coordinates(args['location'], args['geolocation_ttl']))
+
+    if changed & {'city', 'no_weather', 'geolocation_ttl', 'weather_server'}:
+        updates['city_arg'] = args['city']
+        updates['city'] = None if args['no_weather'] else get_city(args['city'], args['geolocation_ttl'])
+
+    if 'wait' in changed:
+        updates['wait_time'] = args['wait']
+
+    if changed & {'prescale', 'prescale_cache_size'}:
+        updates['prescale_cache_size'] = args['prescale_cache_size'] * 1024 * 1024 if args['prescale'] else 0
+
+    return updates
+
+
+def reload_config(parsed_args):
+    # Read the config file again, and rebuild only what the options that
+    # changed affect (the wallpaper index, the schedule, the weather...). If
+    # the new options do not work, keeps the old ones. Returns whether
+    # anything changed.
+
+    import urllib.error
+
+    old_args = parsed_args['args']
+
+    try:
+        args = get_args(read_config(CONFIG_FILE))
+    except ValueError as e:
+        print('Not reloading {}: {}'.format(CONFIG_FILE, e))
+        return False
+
+    args.update(parsed_args['overrides'])
+
+    for key, name in RESTART_OPTIONS.items():
+        if args[key] != old_args[key]:
+            print('{} only changes on a restart'.format(name))
+            args[key] = old_args[key]
+
+    changed = {key for key in args if args[key] != old_args[key]}
+
+    if not changed:
+        return False
+
+    print('Reloading {}, changed: {}'.format(CONFIG_FILE, ', '.join(sorted(changed))))
+
+    # For looking up the city with
+    weather_server['socket'] = args['weather_server']
+
+    try:
+        updates = get_config_updates(args, changed)
+
+    except (urllib.error.URLError, ValueError) as e:
+        print('Not reloading {}: {}'.format(CONFIG_FILE, e))
+        weather_server['socket'] = old_args['weather_server']
+        return False
+
+    old_index = (parsed_args['walls_dir'], parsed_args['file_format'])
+
+    if ('walls_dir' in updates and (updates['walls_dir'], updates['file_format']) != old_index and
+            old_index in Wallpapers.indexes):
+        Wallpapers.indexes.pop(old_index).close()
+
+    if changed & {'provider', 'cache_dir'}:
+        apply_settings(args)
+
+        weather_circuit.update(failures=0, open_until=0)
+        weather_refresh['retry_at'] = 0
+
+    parsed_args.update(updates)
+    parsed_args['args'] = args
+
+    return True
+
+
+def watch_config():
+    # Runs in a thread of its own, asking the loop to reload the config file
+    # whenever something happens in the config directory. Blocks on inotify
+    # where it can, and looks every CONFIG_POLL_INTERVAL seconds otherwise.
+
+    import select
+
+    import Watch
+
+    while True:
+        # Watch the file too when it exists, as polling only sees the
+        # directory change when files come and go
+        watcher = Watch.Watcher([i for i in [CONFIG_DIR, CONFIG_FILE] if os.path.exists(i)] or [CONFIG_DIR])
+
+        try:
+            while True:
+                if watcher.fileno() is None:
+                    time.sleep(CONFIG_POLL_INTERVAL)
+                else:
+                    select.select([watcher], [], [])
+
+                if watcher.changed():
+                    break
+
+        finally:
+            watcher.close()
+
+        time.sleep(CONFIG_SETTLE_DELAY)
+
+        with control_lock:
+            control_requests['config'] = True
+
+        wake_up()
+
+
+def start_config_watch():
+    threading.Thread(target=watch_config, name='config', daemon=True).start()
+
+
+def finish_control_requests():
+    # The update that applied them is done
+
+    with control_lock:
+        waiters = list(control_waiters)
+        control_waiters.clear()
+
+    for applied in waiters:
+        applied.set()
+
+
+def start_control_socket(parsed_args):
+    import atexit
+
+    import Sockets
+
+    socket_path = parsed_args['control_socket']
+
+    try:
+        server = Sockets.Server(socket_path, lambda message: answer_control_request(message, parsed_args))
+
+    except OSError as e:
+        sys.stderr.write('Could not listen on {}: {}\n'.format(socket_path, e))
+        return
+
+    threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+
+    atexit.register(server.server_close)
+
+    print('Listening for control requests on {}'.format(socket_path))
+
+
+def run_ctl(ctl_argv):
+    # WeatherDesk.py ctl ..., talking to a running WeatherDesk
+
+    ctl_parser = argparse.ArgumentParser(
+        prog='WeatherDesk.py ctl',
+        description='Control a WeatherDesk started with --control-socket.',
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    ctl_parser.add_argument(
+        '-s', '--socket', metavar='socket', type=str,
+        help='Specify the control socket. Default: %s' % get_default_control_socket(),
+        default=get_default_control_socket(),
+        required=False)
+
+    ctl_parser.add_argument(
+        'command', choices=CONTROL_COMMANDS,
+        help='''refresh = fetch the weather and set the wallpaper now
+status = show what WeatherDesk is doing
+set-city name = use the weather for another city
+set-dir directory = use the wallpapers in another directory
+reload = read the wallpaper directory, the config files and the location again''')
+
+    ctl_parser.add_argument('args', nargs='*', help=argparse.SUPPRESS)
+
+    ctl_args = ctl_parser.parse_args(ctl_argv)
+
+    if ctl_args.command == 'set-dir':
+        # WeatherDesk may be running from another directory
+        ctl_args.args = [os.path.abspath(os.path.expanduser(i)) for i in ctl_args.args]
+
+    import Sockets
+
+    try:
+        answer = Sockets.request(ctl_args.socket, {'command': ctl_args.command, 'args': ctl_args.args})
+
+    except (OSError, ValueError) as e:
+        sys.stderr.write('Could not reach WeatherDesk on {}: {}\n'.format(ctl_args.socket, e))
+        return 1
+
+    if 'error' in answer:
+        sys.stderr.write(answer['error'] + '\n')
+        return 1
+
+    print(json.dumps(answer, indent=2))
+
+    return 0
+
+
+def clock_jumped(wall_before, monotonic_before):
+    drift = (time.time() - wall_before) - (time.monotonic() - monotonic_before)
+
+    if abs(drift) > CLOCK_JUMP_TOLERANCE:
+        print('Clock jumped by {:.0f} seconds (suspend/resume?), updating now'.format(drift))
+        return True
+
+    return False
+
+
+def sleep_until(wake_time, max_nap=60, wake_event=None):
+    # Sleep in short naps, checking the wall clock after each. The monotonic
+    # clock sleep() uses stops during suspend, so this notices a resume (or
+    # a clock change) within one nap instead of sleeping the whole interval.
+    # Setting wake_event (if given) ends the sleep early.
+
+    while True:
+        remaining = wake_time - time.time()
+
+        if remaining <= 0:
+            return
+
+        wall_before, monotonic_before = time.time(), time.monotonic()
+
+        if wake_event is None:
+            time.sleep(min(remaining, max_nap))
+
+        elif wake_event.wait(min(remaining, max_nap)):
+            wake_event.clear()
+            return
+
+        if clock_jumped(wall_before, monotonic_before):
+            return
+
+
+async def sleep_until_async(wake_time, max_nap=60, wake_event=None):
+    # wake_event is an asyncio.Event here
+
+    import asyncio
+
+    while True:
+        remaining = wake_time - time.time()
+
+        if remaining <= 0:
+            return
+
+        wall_before, monotonic_before = time.time(), time.monotonic()
+
+        if wake_event is None:
+            await asyncio.sleep(min(remaining, max_nap))
+
+        else:
+            try:
+                await asyncio.wait_for(wake_event.wait(), min(remaining, max_nap))
+
+            except asyncio.TimeoutError:
+                pass
+
+            else:
+                wake_event.clear()
+                return
+
+        if clock_jumped(wall_before, monotonic_before):
+            return
+
+
+def wake_up():
+    # Wake up the loop (from another thread), whichever kind is running
+
+    wake_loop.set()
+
+    loop = async_wake['loop']
+
+    if loop is not None:
+        try:
+            loop.call_soon_threadsafe(async_wake['event'].set)
+        except RuntimeError:  # Closed already
+            pass
+
+
+def get_wallpaper_state(file_name, desktop_env):
+    try:
+        mtime = os.stat(file_name).st_mtime
+    except OSError:
+        mtime = None
+
+    display = os.environ.get('WAYLAND_DISPLAY') or os.environ.get('DISPLAY')
+
+    # A list, not a tuple, so that it compares equal after a JSON round-trip
+    return [file_name, mtime, desktop_env, display]
+
+
+def get_conditional_file_name(city, schedule, no_weather, walls_dir, file_format, cache_ttl=600,
+                              rotation='shuffle', max_weather_age=None, wait_time=600):
+    # With max_weather_age, the weather is never waited for (see
+    # get_known_weather()), otherwise it is fetched if need be
+
+    weather_code = None
+
+    if not no_weather:
+        if max_weather_age is None:
+            weather, actual_city, condition_code = get_current_weather(city, cache_ttl)
+        else:
+            weather, actual_city, condition_code = get_known_weather(city, cache_ttl, max_weather_age, wait_time)
+
+        if weather is not None:
+            with Metrics.Timer('classification'):
+                weather_code = get_weather_summary(weather, condition_code)
+
+            print('The retrieved weather for {} is {}'.format(actual_city, weather))
+        else:
+            print('No recent weather for {}, going by the time of day only'.format(city))
+
+    time_of_day = schedule.get_period()
+    print('The current time of the day is {}'.format(time_of_day))
+
+    with Metrics.Timer('resolution'):
+        if weather_code is None and not no_weather:
+            try:
+                return find_file_name(None, time_of_day, walls_dir, file_format, rotation)
+            except ValueError:
+                # No wallpapers for just the time of day, make it fair weather
+                return find_file_name('normal', time_of_day, walls_dir, file_format, rotation)
+
+        return find_file_name(weather_code, time_of_day, walls_dir, file_format, rotation)
+
+
+def get_changed_wallpaper_state(file_name, desktop_env, force=False):
+    # The state to remember after setting file_name, or None if it is
+    # already the current wallpaper
+
+    global last_applied_wallpaper
+
+    wallpaper_state = get_wallpaper_state(file_name, desktop_env)
+
+    if last_applied_wallpaper is None:
+        last_applied_wallpaper = load_cache('wallpaper').get('applied')
+
+    if wallpaper_state == last_applied_wallpaper and not force:
+        print('Wallpaper is already {}, not changing'.format(file_name))
+        Metrics.increment('wallpaper_changes_total', result='unchanged')
+        return None
+
+    return wallpaper_state
+
+
+def remember_applied_wallpaper(wallpaper_state):
+    global last_applied_wallpaper
+
+    last_applied_wallpaper = wallpaper_state
+    save_cache('wallpaper', {'applied': wallpaper_state})
+
+
+def prepare_wallpaper(file_name, prescale_cache_size=0):
+    # The image to actually hand to the desktop
+
+    if not prescale_cache_size:
+        return file_name
+
+    import Images
+
+    return Images.get_scaled_image(file_name, os.path.join(CACHE_DIR, 'scaled'), prescale_cache_size)
+
+
+def report_backend_timing(desktop_env):
+    duration = Desktop.backend_timings[desktop_env]['last']
+
+    Metrics.observe('duration_seconds', duration, stage='set_wallpaper')
+
+    print('Setting the wallpaper took {:.3f} seconds'.format(duration))
+
+
+def set_conditional_wallpaper(city, schedule, no_weather, walls_dir, file_format, cache_ttl=600, force=False,
+                              prescale_cache_size=0, rotation='shuffle', max_weather_age=None, wait_time=600):
+    file_name = get_conditional_file_name(city, schedule, no_weather, walls_dir, file_format, cache_ttl,
+                                          rotation, max_weather_age, wait_time)
+
+    desktop_env = Desktop.get_desktop_environment()
+
+    wallpaper_state = get_changed_wallpaper_state(file_name, desktop_env, force)
+
+    if wallpaper_state is None:
+        return
+
+    print('Changing wallpaper to {}'.format(file_name))
+
+    if Desktop.set_wallpaper(prepare_wallpaper(file_name, prescale_cache_size), desktop_env):
+        remember_applied_wallpaper(wallpaper_state)
+        Metrics.increment('wallpaper_changes_total', result='changed')
+    else:
+        Metrics.increment('wallpaper_changes_total', result='failed')
+
+    report_backend_timing(desktop_env)
+
+
+async def set_conditional_wallpaper_async(city, schedule, no_weather, walls_dir, file_format, cache_ttl=600,
+                                          force=False, prescale_cache_size=0, rotation='shuffle',
+                                          max_weather_age=None, wait_time=600):
+    # Same as set_conditional_wallpaper(), but the weather fetch and the
+    # desktop detection run side by side, and the desktop's commands cannot
+    # hold up the loop for longer than their timeout
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    file_name, desktop_env = await asyncio.gather(
+        loop.run_in_executor(None, get_conditional_file_name,
+                             city, schedule, no_weather, walls_dir, file_format, cache_ttl, rotation,
+                             max_weather_age, wait_time),
+        loop.run_in_executor(None, Desktop.get_desktop_environment))
+
+    wallpaper_state = get_changed_wallpaper_state(file_name, desktop_env, force)
+
+    if wallpaper_state is None:
+        return
+
+    print('Changing wallpaper to {}'.format(file_name))
+
+    image = await loop.run_in_executor(None, prepare_wallpaper, file_name, prescale_cache_size)
+
+    if await Desktop.set_wallpaper_async(image, desktop_env):
+        remember_applied_wallpaper(wallpaper_state)
+        Metrics.increment('wallpaper_changes_total', result='changed')
+    else:
+        Metrics.increment('wallpaper_changes_total', result='failed')
+
+    report_backend_timing(desktop_env)
+
+
+def get_retry_delay(failures, wait_time=600):
+    # Exponential backoff with jitter, so that many instances that lost the
+    # network together do not all retry at the same moment
+
+    delay = min(wait_time, RETRY_DELAY * 2 ** (failures - 1))
+
+    import random
+
+    return random.uniform(delay / 2, delay)
+
+
+def refresh_resolver():
+    # glibc before 2.26 only loads /etc/resolv.conf once, which breaks our
+    # network communications after suspend/resume. Newer versions reload it
+    # by themselves when it changes, so only the old ones need res_init().
+
+    if not sys.platform.startswith('linux'):
+        return
+
+    import platform
+
+    libc_name, libc_version = platform.libc_ver()
+
+    if libc_name != 'glibc':
+        return
+
+    try:
+        if tuple(int(i) for i in libc_version.split('.')[:2]) >= (2, 26):
+            return
+    except ValueError:
+        pass
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None)
+        res_init = getattr(libc, '__res_init', None) or libc.res_init
+        res_init()
+
+    except (OSError, AttributeError):
+        pass
+
+
+def get_update_command(parsed_args):
+    # The command line for one update by the time of day, as the timers
+    # exported by export_schedule() run it
+
+    command = [sys.executable, os.path.abspath(__file__), '--one-time-run', '--no-weather',
+               '--dir', parsed_args['walls_dir'],
+               '--format', parsed_args['file_format'],
+               '--time', str(parsed_args['time']),
+               '--thresholds'] + ['{:02d}:{:02d}'.format(*divmod(i, 60)) for i in parsed_args['schedule'].starts] + [
+               '--rotate', parsed_args['rotate']]
+
+    if parsed_args['prescale']:
+        command += ['--prescale', '--prescale-cache-size', str(parsed_args['args']['prescale_cache_size'])]
+
+    return command
+
+
+def export_schedule(parsed_args):
+    # --export-schedule: write out the whole day, so the desktop (or a timer)
+    # changes the wallpaper without WeatherDesk running. Returns the exit
+    # status.
+
+    import Export
+
+    wallpaper_index = Wallpapers.get_index(parsed_args['walls_dir'], parsed_args['file_format'])
+
+    # With several wallpapers for a time of day, the first one
+    slides = Export.get_slides(parsed_args['schedule'],
+                               lambda daytime: wallpaper_index.get(get_wallpaper_name(None, daytime)))
+
+    directory = os.path.abspath(os.path.expanduser(parsed_args['export_schedule']))
+    os.makedirs(directory, exist_ok=True)
+
+    desktop_env = Desktop.get_desktop_environment()
+
+    if desktop_env in Desktop.SLIDESHOW_DESKTOPS:
+        slideshow = os.path.join(directory, Export.SLIDESHOW_FILE)
+
+        Files.write_text(slideshow, Export.format_slideshow(slides, datetime.date.today()))
+
+        if not Desktop.set_wallpaper(slideshow, desktop_env):
+            return 1
+
+        remember_applied_wallpaper(get_wallpaper_state(slideshow, desktop_env))
+
+        print('The wallpaper is now {}, the desktop changes it with the time of day from here.'.format(slideshow))
+
+        return 0
+
+    command = get_update_command(parsed_args)
+    changes = Export.get_changes(slides)
+
+    for file_name, text in [(Export.SERVICE_FILE, Export.format_service(command)),
+                            (Export.TIMER_FILE, Export.format_timer(changes)),
+                            (Export.CRONTAB_FILE, Export.format_crontab(changes, command))]:
+        Files.write_text(os.path.join(directory, file_name), text)
+
+    set_conditional_wallpaper(parsed_args['city'],
+                              parsed_args['schedule'],
+                              parsed_args['no_weather'],
+                              parsed_args['walls_dir'],
+                              parsed_args['file_format'],
+                              parsed_args['cache_ttl'],
+                              parsed_args['force'],
+                              parsed_args['prescale_cache_size'],
+                              parsed_args['rotate'])
+
+    print('''
+{desktop} cannot change the wallpaper by itself. To have it changed with the time of day, either install the systemd timer:
+
+    systemctl --user link {service} {timer}
+    systemctl --user enable --now {timer_name}
+
+or add the lines in {crontab} to your crontab (crontab -e). Cron may need DISPLAY set to reach the desktop.'''.format(
+        desktop=desktop_env, service=os.path.join(directory, Export.SERVICE_FILE),
+        timer=os.path.join(directory, Export.TIMER_FILE), timer_name=Export.TIMER_FILE,
+        crontab=os.path.join(directory, Export.CRONTAB_FILE)))
+
+    return 0
+
+
+def write_metrics(parsed_args):
+    if parsed_args['metrics']:
+        Metrics.write(parsed_args['metrics'])
+
+
+async def main_loop_async(parsed_args):
+    import asyncio
+    import traceback
+    import urllib.error
+
+    import Http
+
+    network_failures = 0
+
+    loop = asyncio.get_running_loop()
+
+    async_wake['event'] = asyncio.Event()
+    async_wake['loop'] = loop
+
+    while True:
+        force = await loop.run_in_executor(None, prepare_update, parsed_args)
+
+        try:
+            await set_conditional_wallpaper_async(parsed_args['city'],
+                                                  parsed_args['schedule'],
+                                                  parsed_args['no_weather'],
+                                                  parsed_args['walls_dir'],
+                                                  parsed_args['file_format'],
+                                                  parsed_args['cache_ttl'],
+                                                  parsed_args['force'] or force,
+                                                  parsed_args['prescale_cache_size'],
+                                                  parsed_args['rotate'],
+                                                  parsed_args['max_weather_age'],
+                                                  parsed_args['wait_time'])
+
+        except urllib.error.URLError:
+            print('[Main loop] \n' + traceback.format_exc())
+            record_update(sys.exc_info()[0])
+
+            network_failures += 1
+
+            Http.close_connections()
+            refresh_resolver()
+
+        except Exception:
+            print('[Main loop] \n' + traceback.format_exc())
+            record_update(sys.exc_info()[0])
+
+        else:
+            print('[Main loop] No error.')
+            record_update()
+
+            network_failures = 0
+
+        write_metrics(parsed_args)
+
+        finish_control_requests()
+
+        await sleep_until_async(schedule_next_update(parsed_args, network_failures), wake_event=async_wake['event'])
+
+
+if __name__ == '__main__':
+
+    if sys.argv[1:2] == ['ctl']:
+        sys.exit(run_ctl(sys.argv[2:]))
+
+    try:
+        args = get_args(read_config(CONFIG_FILE))
+    except ValueError as e:
+        sys.stderr.write('Invalid {}: {}\n'.format(CONFIG_FILE, e))
+        sys.exit(1)
+
+    apply_settings(args)
+
+    # Before validate_args(), which can take a network round trip
+    if args['naming']:
+        print(NAMING_RULES.format(get_file_format(args['format']), os.path.join(CONFIG_DIR, Weather.MAPPING_FILE)))
+        sys.exit(0)
+
+    if args['serve_weather']:
+        serve_weather(args)
+        sys.exit(0)
+
+    parsed_args = validate_args(args)
+
+    if parsed_args['export_schedule']:
+        sys.exit(export_schedule(parsed_args))
+
+    if parsed_args['one_time_run']:
+        try:
+            set_conditional_wallpaper(parsed_args['city'],
+                                      parsed_args['schedule'],
+                                      parsed_args['no_weather'],
+                                      parsed_args['walls_dir'],
+                                      parsed_args['file_format'],
+                                      parsed_args['cache_ttl'],
+                                      parsed_args['force'],
+                                      parsed_args['prescale_cache_size'],
+                                      parsed_args['rotate'])
+        except Exception:
+            record_update(sys.exc_info()[0])
+            raise
+        else:
+            record_update()
+        finally:
+            write_metrics(parsed_args)
+
+        sys.exit(0)
+
+    if parsed_args['control_socket']:
+        start_control_socket(parsed_args)
+
+    start_config_watch()
+
+    if parsed_args['async_mode']:
+        import asyncio
+
+        try:
+            asyncio.run(main_loop_async(parsed_args))
+        except KeyboardInterrupt:
+            pass
+
+        sys.exit(0)
+
+    import traceback
+    import urllib.error
+
+    import Http
+
+    trace_main_loop = None
+
+    network_failures = 0
+
+    while True:
+        force = prepare_update(parsed_args)
+
+        try:
+            set_conditional_wallpaper(parsed_args['city'],
+                                      parsed_args['schedule'],
+                                      parsed_args['no_weather'],
+                                      parsed_args['walls_dir'],
+                                      parsed_args['file_format'],
+                                      parsed_args['cache_ttl'],
+                                      parsed_args['force'] or force,
+                                      parsed_args['prescale_cache_size'],
+                                      parsed_args['rotate'],
+                                      parsed_args['max_weather_age'],
+                                      parsed_args['wait_time'])
+
+        except urllib.error.URLError:
+            # Don't shut off on temporary network problems, retry with backoff
+            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+            record_update(sys.exc_info()[0])
+
+            network_failures += 1
+
+            # Addresses may have changed along with the network
+            Http.close_connections()
+            refresh_resolver()
+
+        except ValueError:
+            # Sometimes JSON returns a null value for no reason
+
+            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+            record_update(sys.exc_info()[0])
+
+        except:
+            # All other errors (except KeyboardInterrupt ^C)
+            # We'll still have a full stack trace
+
+            trace_main_loop = '[Main loop] \n' + traceback.format_exc()
+            record_update(sys.exc_info()[0])
+
+        else:
+            trace_main_loop = '[Main loop] No error.'
+            record_update()
+
+            network_failures = 0
 
         finally:
             if trace_main_loop:
                 print(trace_main_loop)
 
-        time.sleep(parsed_args['wait_time'])
+            write_metrics(parsed_args)
+
+            finish_control_requests()
+
+        sleep_until(schedule_next_update(parsed_args, network_failures), wake_event=wake_loop)
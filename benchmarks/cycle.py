@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+# What one refresh cycle (set_conditional_wallpaper()) costs, offline: the
+# real code runs against a local stand-in for the geolocation and weather
+# APIs, and fake desktop commands on PATH. For each desktop backend and
+# --time level it reports the time spent in each stage, processes spawned and
+# peak RSS. Each combination runs in a process of its own, so that their RSS
+# can be told apart.
+#
+#     $ python3 benchmarks/cycle.py [--cycles N] [--latency MS] [--failure-rate F]
+
+import argparse
+import http.server
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ['gnome', 'xfce4', 'kde', 'i3', 'icewm']
+
+TIME_LEVELS = [2, 3, 4]
+
+STAGES = ['geolocation', 'weather', 'selection', 'detection', 'backend']
+
+# Yahoo! Weather conditions, with their codes
+CONDITIONS = [('Rain', 12), ('Cloudy', 26), ('Sunny', 32), ('Snow', 16), ('Thunderstorms', 4), ('Windy', 24),
+              ('Light Rain Showers', 11), ('Mostly Cloudy', 28)]
+
+# Prints the /backdrop properties of 2 monitors x 2 workspaces when listing
+FAKE_COMMAND = '''#!/bin/sh
+echo "$0" >> "{log}"
+case "$0 $*" in
+    *xfconf-query*-l*)
+        for m in 0 1; do
+            for w in 0 1; do
+                echo /backdrop/screen0/monitor$m/workspace$w/last-image
+            done
+        done
+        ;;
+esac
+'''
+
+FAKE_COMMANDS = ['gsettings', 'xfconf-query', 'xfdesktop', 'dbus-send', 'feh', 'icewmbg']
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # ipinfo.io's /json and Yahoo's /v1/public/yql, with the latency and
+    # failure rate set on the server
+
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately, do not let them wait for
+    # delayed ACKs and add to the latency being measured
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.failure_rate:
+            self.send_reply(503, b'')
+            return
+
+        if self.path.startswith('/json'):
+            reply = {'city': 'Benchmark'}
+
+        elif self.path.startswith('/v1/public/yql'):
+            text, code = random.choice(CONDITIONS)
+
+            reply = {'query': {'results': {'channel': {
+                'item': {'condition': {'text': text, 'code': str(code)}},
+                'location': {'city': 'Benchmark', 'region': ' BM'}}}}}
+
+        else:
+            self.send_reply(404, b'')
+            return
+
+        self.send_reply(200, json.dumps(reply).encode('utf-8'), 'application/json')
+
+    def send_reply(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(latency, failure_rate):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def install_fake_commands(bin_dir, log):
+    for name in FAKE_COMMANDS:
+        path = os.path.join(bin_dir, name)
+
+        with open(path, 'w') as f:
+            f.write(FAKE_COMMAND.format(log=log))
+
+        os.chmod(path, 0o755)
+
+
+def make_wallpapers(walls_dir):
+    import WeatherDesk
+
+    weathers = [None, 'rain', 'wind', 'thunder', 'snow', 'cloudy', 'normal']
+    daytimes = [None, 'morning', 'day', 'evening', 'night']
+
+    for weather in weathers:
+        for daytime in daytimes:
+            if weather or daytime:
+                open(os.path.join(walls_dir, WeatherDesk.get_wallpaper_name(weather, daytime) + '.jpg'), 'w').close()
+
+
+def timed(timings, stage, function):
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+
+        try:
+            return function(*args, **kwargs)
+
+        finally:
+            timings[stage] += time.monotonic() - start
+
+    return wrapper
+
+
+def run_worker(port, time_level, cycles, walls_dir):
+    # Runs in a process of its own, with the environment set up by
+    # run_benchmark(), and prints its results as JSON
+
+    import resource
+    import urllib.error
+
+    # Use the desktops' commands, not whatever PyGObject this machine has
+    sys.modules['gi'] = None
+
+    import Daytime
+    import Desktop
+    import Http
+    import WeatherDesk
+
+    # Send every request to the stand-in, through the real client
+    connect = Http.get_connection
+    Http.get_connection = lambda scheme, host, port_: connect('http', '127.0.0.1', port)
+
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    WeatherDesk.get_city = timed(timings, 'geolocation', WeatherDesk.get_city)
+    WeatherDesk.get_current_weather = timed(timings, 'weather', WeatherDesk.get_current_weather)
+    WeatherDesk.find_file_name = timed(timings, 'selection', WeatherDesk.find_file_name)
+    Desktop.get_desktop_environment = timed(timings, 'detection', Desktop.get_desktop_environment)
+    Desktop.set_wallpaper = timed(timings, 'backend', Desktop.set_wallpaper)
+
+    failures = 0
+    stdout = sys.stdout
+
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        start = time.monotonic()
+
+        for i in range(cycles):
+            try:
+                # Geolocated every cycle, as it is for each update of a
+                # restarted --one-time-run (mostly from the cache)
+                WeatherDesk.ip_location.clear()
+                city = WeatherDesk.get_city(None)
+
+                # No weather cache and a forced change, so every stage runs
+                WeatherDesk.set_conditional_wallpaper(city, Daytime.get_schedule(time_level), False, walls_dir, '.jpg',
+                                                      cache_ttl=0, force=True)
+
+            except urllib.error.URLError:
+                failures += 1
+
+        duration = time.monotonic() - start
+        sys.stdout = stdout
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    print(json.dumps({
+        'total': duration,
+        'timings': timings,
+        'failures': failures,
+        'max_rss': usage.ru_maxrss,
+    }))
+
+
+def run_benchmark(desktop_env, time_level, port, cycles, temp_dir, walls_dir):
+    log = os.path.join(temp_dir, 'spawned')
+
+    if os.path.exists(log):
+        os.remove(log)
+
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(temp_dir, 'bin') + os.pathsep + env['PATH']
+    env['XDG_CURRENT_DESKTOP'] = desktop_env
+    env['XDG_CACHE_HOME'] = tempfile.mkdtemp(dir=temp_dir)
+
+    for name in ['DESKTOP_SESSION', 'http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']:
+        env.pop(name, None)
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                             str(port), str(time_level), str(cycles), walls_dir],
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+    result = json.loads(output.decode('utf-8').splitlines()[-1])
+
+    try:
+        with open(log) as f:
+            result['processes'] = len(f.readlines())
+    except OSError:
+        result['processes'] = 0
+
+    return result
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        port, time_level, cycles = [int(i) for i in sys.argv[2:5]]
+        run_worker(port, time_level, cycles, sys.argv[5])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmark the refresh cycle against local stand-ins.')
+    parser.add_argument('--cycles', type=int, default=20, help='Cycles for each backend and --time level')
+    parser.add_argument('--latency', type=float, default=20, help='Stand-in server latency, in milliseconds')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Share of requests the stand-in fails')
+    args = parser.parse_args()
+
+    server = start_stand_in(args.latency / 1000, args.failure_rate)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        walls_dir = os.path.join(temp_dir, 'walls')
+        os.mkdir(walls_dir)
+        make_wallpapers(walls_dir)
+
+        os.mkdir(os.path.join(temp_dir, 'bin'))
+        install_fake_commands(os.path.join(temp_dir, 'bin'), os.path.join(temp_dir, 'spawned'))
+
+        print('{} cycles each, {:.0f} ms latency, {:.0%} failures\n'.format(
+            args.cycles, args.latency, args.failure_rate))
+        print('{:<8} {:>4} '.format('backend', 'time') +
+              ' '.join('{:>11}'.format(i) for i in STAGES) +
+              ' {:>9} {:>9} {:>8} {:>8}'.format('ms/cycle', 'procs', 'failed', 'RSS MB'))
+
+        for desktop_env in BACKENDS:
+            for time_level in TIME_LEVELS:
+                result = run_benchmark(desktop_env, time_level, server.server_address[1], args.cycles,
+                                       temp_dir, walls_dir)
+
+                print('{:<8} {:>4} '.format(desktop_env, time_level) +
+                      ' '.join('{:>11.2f}'.format(result['timings'][i] * 1000 / args.cycles) for i in STAGES) +
+                      ' {:>9.2f} {:>9.1f} {:>8} {:>8.1f}'.format(
+                          result['total'] * 1000 / args.cycles, result['processes'] / args.cycles,
+                          result['failures'], result['max_rss'] / 1024))
+
+    server.shutdown()
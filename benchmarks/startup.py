@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Time to start up and finish for the short-lived invocations: --naming, and
+# a --one-time-run --no-weather change, with a fake wallpaper command. Also
+# lists the slowest imports (from python -X importtime), to catch a module
+# being imported eagerly again. Exits with 1 if a run is over TARGET.
+#
+#     $ python3 benchmarks/startup.py [runs]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+WEATHERDESK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'WeatherDesk.py')
+
+# Seconds, for the best of the runs
+TARGET = 0.15
+
+FAKE_ICEWMBG = '''#!/bin/sh
+exit 0
+'''
+
+
+def make_environment(temp_dir):
+    bin_dir = os.path.join(temp_dir, 'bin')
+    walls_dir = os.path.join(temp_dir, 'walls')
+
+    os.mkdir(bin_dir)
+    os.mkdir(walls_dir)
+
+    path = os.path.join(bin_dir, 'icewmbg')
+
+    with open(path, 'w') as f:
+        f.write(FAKE_ICEWMBG)
+
+    os.chmod(path, 0o755)
+
+    for daytime in ['morning', 'day', 'evening', 'night']:
+        open(os.path.join(walls_dir, daytime + '.jpg'), 'w').close()
+
+    # Nothing from the user's own setup: their config file (or the cache in
+    # it) would change what is being timed
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env['PATH']
+    env['HOME'] = temp_dir
+    env['XDG_CURRENT_DESKTOP'] = 'icewm'
+    env['XDG_CONFIG_HOME'] = os.path.join(temp_dir, 'config')
+    env['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+
+    return env, walls_dir
+
+
+def with_fresh_cache(env):
+    # Every run starts from an empty cache, or all but the first
+    # --one-time-run would only find the wallpaper already set
+    env = dict(env)
+    env['XDG_CACHE_HOME'] = tempfile.mkdtemp(dir=os.path.dirname(env['XDG_CACHE_HOME']), prefix='cache-')
+    return env
+
+
+def run(args, env):
+    env = with_fresh_cache(env)
+    start = time.monotonic()
+    subprocess.run([sys.executable] + args, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.monotonic() - start
+
+
+def get_slowest_imports(args, env, count=10):
+    # [(cumulative microseconds, module)], slowest first
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + args, env=with_fresh_cache(env),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr
+
+    imports = []
+
+    for line in output.decode('utf-8', 'replace').splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        fields = line.split('|')
+
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        imports.append((int(fields[1]), fields[2].strip()))
+
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env, walls_dir = make_environment(temp_dir)
+
+        invocations = [
+            ('--naming', [WEATHERDESK, '--naming']),
+            ('--one-time-run', [WEATHERDESK, '--no-weather', '--one-time-run', '--dir', walls_dir]),
+        ]
+
+        # Python itself, for reference
+        baseline = min(run(['-c', 'pass'], env) for i in range(runs))
+
+        print('{} runs each, target {:.0f} ms, bare interpreter {:.0f} ms\n'.format(
+            runs, TARGET * 1000, baseline * 1000))
+        print('{:<16} {:>8} {:>8}'.format('invocation', 'best ms', 'mean ms'))
+
+        over_target = False
+
+        for name, args in invocations:
+            times = [run(args, env) for i in range(runs)]
+
+            print('{:<16} {:>8.0f} {:>8.0f}'.format(name, min(times) * 1000, sum(times) * 1000 / runs))
+
+            over_target = over_target or min(times) > TARGET
+
+        print('\nSlowest imports for --one-time-run (cumulative ms):\n')
+
+        for microseconds, module in get_slowest_imports(invocations[1][1], env):
+            print('{:>8.1f}  {}'.format(microseconds / 1000, module))
+
+    sys.exit(1 if over_target else 0)
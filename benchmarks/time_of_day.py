@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of finding the time of day, and when it next changes: the precomputed
+# Daytime.Schedule against the sort-based lookup and the hour by hour search
+# it replaced (copied below).
+#
+#     $ python3 benchmarks/time_of_day.py [level] [calls]
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Daytime
+
+
+def get_time_of_day_sorted(level=3, hour=None):
+    if hour is None:
+        current_hour = datetime.datetime.now().hour
+    else:
+        current_hour = hour
+
+    if level == 2:
+        labels = ['day', 'night']
+        thres = [5, 19]
+    elif level == 3:
+        labels = ['day', 'evening', 'night']
+        thres = [5, 16, 19]
+    elif level == 4:
+        labels = ['morning', 'day', 'evening', 'night']
+        thres = [5, 7, 16, 19]
+    else:
+        raise ValueError('Invalid time level.')
+
+    thres.append(current_hour)
+    thres.sort()
+    day_index = thres.index(current_hour)
+    return labels[day_index - 1]
+
+
+def get_next_change_hourly(level=3, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+
+    this_hour = now.replace(minute=0, second=0, microsecond=0)
+    current_time_of_day = get_time_of_day_sorted(level, now.hour)
+
+    for hours_ahead in range(1, 25):
+        change = this_hour + datetime.timedelta(hours=hours_ahead)
+
+        if get_time_of_day_sorted(level, change.hour) != current_time_of_day:
+            return change
+
+    raise ValueError('Time of day never changes.')
+
+
+def benchmark(name, function, times, calls):
+    # function is called with each of times in turn
+    seconds = min(timeit.repeat(lambda: [function(now) for now in times], number=max(1, calls // len(times)),
+                                repeat=5))
+    print('{:<28} {:>10.3f}'.format(name, seconds * 1e6 / (max(1, calls // len(times)) * len(times))))
+
+
+if __name__ == '__main__':
+    level, calls = [int(i) for i in (sys.argv[1:] + ['3', '100000'][len(sys.argv) - 1:])]
+
+    schedule = Daytime.get_schedule(level)
+
+    # Every hour of a day, so that every period and boundary is hit
+    times = [datetime.datetime(2016, 6, 1, hour, 30) for hour in range(24)]
+
+    for now in times:
+        assert schedule.get_period(now) == get_time_of_day_sorted(level, now.hour)
+        assert schedule.get_next_boundary(now) == get_next_change_hourly(level, now)
+
+    print('--time {}, {} calls\n'.format(level, calls))
+    print('{:<28} {:>10}'.format('', 'us/call'))
+
+    benchmark('period, sorted list', lambda now: get_time_of_day_sorted(level, now.hour), times, calls)
+    benchmark('period, schedule', schedule.get_period, times, calls)
+    benchmark('next change, hourly search', lambda now: get_next_change_hourly(level, now), times, calls)
+    benchmark('next change, schedule', schedule.get_next_boundary, times, calls)
+
+    # Paid once per run
+    benchmark('building the schedule', lambda now: Daytime.Schedule(Daytime.LABELS[level], schedule.starts),
+              times[:1], 100)
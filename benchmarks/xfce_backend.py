@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+# Processes spawned and time taken per wallpaper change on XFCE, with fake
+# xfconf-query and xfdesktop commands for a multi-monitor, multi-workspace
+# setup. Compares the batched backend with one write and one reload per
+# property, as it used to be.
+#
+#     $ python3 benchmarks/xfce_backend.py [monitors] [workspaces] [changes]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Desktop
+
+FAKE_XFCONF_QUERY = '''#!/bin/sh
+echo x >> "{log}"
+case "$*" in
+    *-l*)
+        for m in $(seq 0 {last_monitor}); do
+            for w in $(seq 0 {last_workspace}); do
+                echo /backdrop/screen0/monitor$m/workspace$w/color-style
+                echo /backdrop/screen0/monitor$m/workspace$w/last-image
+            done
+        done
+        ;;
+esac
+'''
+
+FAKE_XFDESKTOP = '''#!/bin/sh
+echo x >> "{log}"
+'''
+
+
+def install_fake_commands(bin_dir, log, monitors, workspaces):
+    for name, script in [('xfconf-query', FAKE_XFCONF_QUERY), ('xfdesktop', FAKE_XFDESKTOP)]:
+        path = os.path.join(bin_dir, name)
+
+        with open(path, 'w') as f:
+            f.write(script.format(log=log, last_monitor=monitors - 1, last_workspace=workspaces - 1))
+
+        os.chmod(path, 0o755)
+
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+def count_processes(log):
+    try:
+        with open(log) as f:
+            return len(f.readlines())
+    except OSError:
+        return 0
+
+
+def set_wallpaper_per_property(image):
+    list_of_properties = Desktop.get_command_output(['xfconf-query', '-R', '-l', '-c', 'xfce4-desktop', '-p', '/backdrop'])
+
+    for i in list_of_properties.split('\n'):
+        if i.endswith('last-image'):
+            subprocess.run(['xfconf-query', '-c', 'xfce4-desktop', '-p', i, '-s', image])
+            subprocess.run(['xfdesktop', '--reload'])
+
+
+def set_wallpaper_batched(image):
+    Desktop.set_wallpaper(image, 'xfce4')
+
+
+def benchmark(name, set_wallpaper, log, changes):
+    if os.path.exists(log):
+        os.remove(log)
+
+    Desktop.backends.clear()
+
+    start = time.monotonic()
+
+    for i in range(changes):
+        set_wallpaper('/tmp/wallpaper-%d.jpg' % i)
+
+    duration = time.monotonic() - start
+
+    print('{:<14} {:>10.1f} {:>12.1f}'.format(
+        name, count_processes(log) / changes, duration * 1000 / changes))
+
+
+if __name__ == '__main__':
+    monitors, workspaces, changes = [int(i) for i in (sys.argv[1:] + ['4', '4', '10'][len(sys.argv) - 1:])]
+
+    # Measure the subprocess path, not whatever xfconfd this machine may have
+    def no_dbus(backend, image):
+        raise ImportError
+
+    Desktop.XfceBackend.set_properties_over_dbus = no_dbus
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log = os.path.join(temp_dir, 'spawned')
+        install_fake_commands(temp_dir, log, monitors, workspaces)
+
+        print('{} monitors x {} workspaces, {} changes\n'.format(monitors, workspaces, changes))
+        print('{:<14} {:>10} {:>12}'.format('backend', 'processes', 'ms/change'))
+
+        benchmark('per-property', set_wallpaper_per_property, log, changes)
+        benchmark('batched', set_wallpaper_batched, log, changes)
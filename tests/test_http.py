@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright © 2016 Bharadwaj Raju <bharadwaj.raju777@gmail.com>
+# All Rights Reserved.
+# This file is part of WeatherDesk.
+#
+# WeatherDesk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WeatherDesk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WeatherDesk (in the LICENSE file).
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+# Http.get_json() against a stand-in server on 127.0.0.1
+#
+#     $ python3 -m unittest discover tests
+
+import gzip
+import http.server
+import json
+import os
+import socket
+import sys
+import threading
+import unittest
+import urllib.error
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Http
+
+WEATHER = {'query': {'results': {'channel': {'item': {'condition': {'text': 'Rain', 'code': '12'}}}}}}
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        body = json.dumps(WEATHER).encode('utf-8')
+
+        if self.path == '/redirect':
+            self.send_body(302, b'', [('Location', '/weather')])
+
+        elif self.path == '/gzip' and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            self.send_body(200, gzip.compress(body), [('Content-Encoding', 'gzip')])
+
+        elif self.path == '/etag' and self.headers.get('If-None-Match') == '"1"':
+            self.send_body(304, b'', [('ETag', '"1"')])
+
+        elif self.path == '/missing':
+            self.send_body(404, b'')
+
+        else:
+            self.send_body(200, body, [('ETag', '"1"')])
+
+        if self.server.drop_connections:
+            # Without saying so, as servers do after an idle timeout
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class GetJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        # Proxies would bypass our connections
+        for name in ['http_proxy', 'HTTP_PROXY', 'all_proxy', 'ALL_PROXY']:
+            os.environ.pop(name, None)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.connections = 0
+        self.server.drop_connections = False
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        Http.close_connections()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_json(self, path, headers=None):
+        return Http.get_json('http://127.0.0.1:%d%s' % (self.server.server_address[1], path), headers)
+
+    def test_json(self):
+        status, headers, data = self.get_json('/weather')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, WEATHER)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.assertEqual(self.get_json('/weather')[2], WEATHER)
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect_once(self):
+        self.server.drop_connections = True
+
+        for i in range(3):
+            self.assertEqual(self.get_json('/weather')[2], WEATHER)
+
+        self.assertEqual(self.server.connections, 3)
+
+    def test_gzip(self):
+        status, headers, data = self.get_json('/gzip')
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data, WEATHER)
+
+    def test_not_modified(self):
+        status, headers, data = self.get_json('/etag', {'If-None-Match': '"1"'})
+
+        self.assertEqual(status, 304)
+        self.assertIsNone(data)
+
+        # And the connection is still good
+        self.assertEqual(self.get_json('/weather')[2], WEATHER)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect(self):
+        status, headers, data = self.get_json('/redirect')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, WEATHER)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            self.get_json('/missing')
+
+        self.assertEqual(error.exception.code, 404)
+
+    def test_no_server(self):
+        # A port nothing listens on any more
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            port = closed.getsockname()[1]
+
+        with self.assertRaises(urllib.error.URLError):
+            Http.get_json('http://127.0.0.1:%d/weather' % port)
+
+if __name__ == '__main__':
+    unittest.main()